@@ -14,28 +14,25 @@ if __name__ == '__main__':
     ind_rets = erk.get_ind_returns(weighting="ew", n_inds=49)["1974":]
     ind_mcap = erk.get_ind_market_caps(49, weights=True)["1974":]
 
-    # Equally weighted portfolio
-    ewr = erk.backtest_ws(ind_rets, estimation_window=36, weighting=erk.weight_ew)
-
-    # Cap weighted portfolio
-    cwr = erk.backtest_ws(ind_rets, estimation_window=36, weighting=erk.weight_cw, cap_weights=ind_mcap)
-
-    # Minimum variance portfolio
-    mv_s_r = erk.backtest_ws(ind_rets, estimation_window=36, weighting=erk.weight_gmv, cov_estimator=erk.sample_cov)
-
-    # Now, let's try a new estimator - Constant Correlation. The idea is simple, take the sample correlation matrix,
-    # compute the average correlation and then reconstruct the covariance matrix. The relation between correlations 𝜌
-    # and covariance 𝜎 is given by: rho_ij = sig_ij / sqrt(sig_ii * sig_jj)
-    mv_cc_r = erk.backtest_ws(ind_rets, estimation_window=36, weighting=erk.weight_gmv, cov_estimator=erk.cc_cov)
-
-    # We can mix the model and sample estimates by choosing a shrinkage parameter. You can either let the numbers
-    # dictate an optimal shrinkage value for 𝛿 although in practice many practitioners choose 0.5. Let's implement
-    # a simple shrinkage based covariance estimator that shrinks towards the Constant Correlation estimate.
-    mv_sh_r = erk.backtest_ws(ind_rets, estimation_window=36, weighting=erk.weight_gmv, cov_estimator=erk.shrinkage_cov,
-                              delta=0.5)
-
-    # Put them all together and calculate returns
-    btr = pd.DataFrame({"EW": ewr, "CW": cwr, "GMV-Sample": mv_s_r, "GMV-CC": mv_cc_r, 'GMV-Shrink 0.5': mv_sh_r})
+    strategies = {
+        # Equally weighted portfolio
+        "EW": dict(weighting=erk.weight_ew),
+        # Cap weighted portfolio
+        "CW": dict(weighting=erk.weight_cw, cap_weights=ind_mcap),
+        # Minimum variance portfolio
+        "GMV-Sample": dict(weighting=erk.weight_gmv, cov_estimator=erk.sample_cov),
+        # Now, let's try a new estimator - Constant Correlation. The idea is simple, take the sample correlation matrix,
+        # compute the average correlation and then reconstruct the covariance matrix. The relation between correlations 𝜌
+        # and covariance 𝜎 is given by: rho_ij = sig_ij / sqrt(sig_ii * sig_jj)
+        "GMV-CC": dict(weighting=erk.weight_gmv, cov_estimator=erk.cc_cov),
+        # We can mix the model and sample estimates by choosing a shrinkage parameter. You can either let the numbers
+        # dictate an optimal shrinkage value for 𝛿 although in practice many practitioners choose 0.5. Let's implement
+        # a simple shrinkage based covariance estimator that shrinks towards the Constant Correlation estimate.
+        'GMV-Shrink 0.5': dict(weighting=erk.weight_gmv, cov_estimator=erk.shrinkage_cov, delta=0.5),
+    }
+
+    # Put them all together and calculate returns, the sample covariance of each window is only estimated once
+    btr = erk.backtest_strategies(ind_rets, strategies, estimation_window=36)
     (1 + btr).cumprod().plot(figsize=(12, 6), title="Industry Portfolios - CW vs EW")
     print(erk.summary_stats(btr.dropna()))
     plt.show()
@@ -19,10 +19,10 @@ if __name__ == '__main__':
                                                                            ax=axes[1])
 
     # Run a backtest of industry portfolios w/ new erk portfolio
-    ewr = erk.backtest_ws(ind_rets, estimation_window=36, weighting=erk.weight_ew)
-    cwr = erk.backtest_ws(ind_rets, estimation_window=36, weighting=erk.weight_cw, cap_weights=ind_mcap)
-    mv_erc_r = erk.backtest_ws(ind_rets, estimation_window=36, weighting=erk.weight_erc, cov_estimator=erk.sample_cov)
-    btr = pd.DataFrame({"EW": ewr, "CW": cwr, 'ERC-Sample': mv_erc_r})
+    btr = erk.backtest_strategies(ind_rets, {"EW": dict(weighting=erk.weight_ew),
+                                             "CW": dict(weighting=erk.weight_cw, cap_weights=ind_mcap),
+                                             'ERC-Sample': dict(weighting=erk.weight_erc, cov_estimator=erk.sample_cov)},
+                                  estimation_window=36)
     (1 + btr).cumprod().plot(figsize=(12, 6), title="Industry Portfolios", ax=axes[2])
     print(erk.summary_stats(btr.dropna()))
     plt.show()
\ No newline at end of file
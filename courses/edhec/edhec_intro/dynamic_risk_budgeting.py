@@ -13,13 +13,9 @@ if __name__ == '__main__':
 
 
     rets_7030b = erk.bt_mix(rets_eq, rets_zc, allocator=erk.fixedmix_allocator, w1=0.7)
-    rets_floor75 = erk.bt_mix(rets_eq, rets_zc, allocator=erk.floor_allocator, floor=.75, zc_prices=zc_prices[1:])
-    rets_floor75m1 = erk.bt_mix(rets_eq, rets_zc, allocator=erk.floor_allocator, zc_prices=zc_prices[1:], floor=.75,
-                                m=1)
-    rets_floor75m5 = erk.bt_mix(rets_eq, rets_zc, allocator=erk.floor_allocator, zc_prices=zc_prices[1:], floor=.75,
-                                m=5)
-    rets_floor75m10 = erk.bt_mix(rets_eq, rets_zc, allocator=erk.floor_allocator, zc_prices=zc_prices[1:], floor=.75,
-                                 m=10)
+    # All the multipliers in one pass, rets_floor75[m] is the bt_mix result for that multiplier
+    rets_floor75 = erk.bt_mix_sweep(rets_eq, rets_zc, allocator=erk.floor_allocator, grid={"m": [3, 1, 5, 10]},
+                                    floor=.75, zc_prices=zc_prices[1:])
 
     # Do max DD allocator
     rets_tmi = erk.get_total_market_index_returns()["1990":]
@@ -30,13 +26,8 @@ if __name__ == '__main__':
     rets_maxdd25 = erk.bt_mix(pd.DataFrame(rets_tmi), rets_cash, allocator=erk.drawdown_allocator, maxdd=.25, m=5)
     dd_25 = erk.drawdown(rets_maxdd25[0])
 
-    # Print all tests
-    print(pd.concat([erk.terminal_stats(rets_zc, name="ZC", floor=0.75),
-           erk.terminal_stats(rets_eq, name="Eq", floor=0.75),
-           erk.terminal_stats(rets_7030b, name="70/30", floor=0.75),
-           erk.terminal_stats(rets_floor75, name="Floor75", floor=0.75),
-           erk.terminal_stats(rets_floor75m1, name="Floor75m1", floor=0.75),
-           erk.terminal_stats(rets_floor75m5, name="Floor75m5", floor=0.75),
-           erk.terminal_stats(rets_floor75m10, name="Floor75m10", floor=0.75)
-          ],
-          axis=1).round(2))
\ No newline at end of file
+    # Print all tests, every strategy is compounded once for the whole table
+    print(erk.terminal_stats_table({"ZC": rets_zc, "Eq": rets_eq, "70/30": rets_7030b,
+                                    "Floor75": rets_floor75[3], "Floor75m1": rets_floor75[1],
+                                    "Floor75m5": rets_floor75[5], "Floor75m10": rets_floor75[10]},
+                                   floors=0.75).droplevel("threshold").round(2))
\ No newline at end of file
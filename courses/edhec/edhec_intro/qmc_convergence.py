@@ -0,0 +1,64 @@
+from courses.edhec import edhec_risk_kit as erk
+import numpy as np
+import pandas as pd
+
+
+def terminal_estimates(n_scenarios, sampler, seed, mu=0.07, floor=0.9):
+    """
+    Terminal wealth statistics of the equities and of a 70/30 equities/zero coupon mix for one set of scenarios
+    The equities and the rates are drawn together (one point of the low discrepancy sequence per scenario)
+    """
+    rng = np.random.default_rng(seed)
+    scenarios = erk.correlated_scenarios(n_years=10, n_scenarios=n_scenarios, mu=mu, sigma=0.15, rng=rng,
+                                         sampler=sampler, cir_params={"b": 0.03, "r_0": 0.03, "sigma": 0.02})
+    rets_eq = pd.DataFrame(scenarios[0]).pct_change().dropna()
+    rets_zc = pd.DataFrame(scenarios["zc_prices"]).pct_change().dropna()
+    rets_7030 = erk.bt_mix(rets_eq, rets_zc, allocator=erk.fixedmix_allocator, w1=0.7)
+    stats = erk.terminal_stats_table({"Eq": rets_eq, "70/30": rets_7030}, floors=floor).droplevel("threshold")
+    return {"Eq mean": stats.loc["mean", "Eq"], "70/30 mean": stats.loc["mean", "70/30"],
+            "70/30 p_breach": stats.loc["p_breach", "70/30"]}
+
+
+def mean_7030_reference(n_scenarios=2**18, block_size=2**14, seed=2024, mu=0.07, w_eq=0.7):
+    """
+    Semi-analytic mean terminal wealth of the 70/30 mix: the equity returns are independent of each other and of
+    the rates, so given the rates the expected growth of each month is w_eq*(1+mu)**(1/12) + (1-w_eq)*(1+r_zc),
+    and only the zero coupon returns are simulated
+    Returns the mean over n_scenarios CIR paths and its standard error
+    """
+    rng = np.random.default_rng(seed)
+    growth = []
+    for _ in range(n_scenarios//block_size):
+        _, zc_prices = erk.cir(10, n_scenarios=block_size, b=0.03, r_0=0.03, sigma=0.02, rng=rng, as_frame=False)
+        growth.append(np.prod(w_eq*(1+mu)**(1/12) + (1-w_eq)*zc_prices[1:]/zc_prices[:-1], axis=0))
+    growth = np.concatenate(growth)
+    return growth.mean(), growth.std(ddof=1)/np.sqrt(len(growth))
+
+
+if __name__ == '__main__':
+    # Compare the root mean square error of plain Monte Carlo and scrambled Sobol shocks on terminal_stats
+    # quantities, over independent replications. The Eq mean is known exactly ((1+mu)**n_years), the 70/30 mean
+    # semi-analytically (mean_7030_reference) and the 70/30 p_breach is the average of independent large Sobol runs,
+    # whose errors are reported next to the table as they bound the smallest RMSE that can be measured
+    mu = 0.07
+    n_reps = 20
+    n_ref_runs = 32
+    ref_runs = pd.DataFrame([terminal_estimates(2**16, "sobol", seed=10_000 + rep, mu=mu)
+                             for rep in range(n_ref_runs)])
+    reference = ref_runs.mean()
+    reference_se = ref_runs.std(ddof=1)/np.sqrt(n_ref_runs)
+    reference["Eq mean"], reference_se["Eq mean"] = (1+mu)**10, 0.
+    reference["70/30 mean"], reference_se["70/30 mean"] = mean_7030_reference(mu=mu)
+    print("References and their standard errors")
+    print(pd.DataFrame({"reference": reference, "standard error": reference_se}))
+
+    rmse = {}
+    for n_scenarios in [2**8, 2**10, 2**12]:
+        for sampler in ["pseudo", "sobol"]:
+            runs = pd.DataFrame([terminal_estimates(n_scenarios, sampler, seed=rep, mu=mu) for rep in range(n_reps)])
+            rmse[(n_scenarios, sampler)] = np.sqrt(((runs - reference)**2).mean())
+    rmse = pd.DataFrame(rmse).T.rename_axis(["n_scenarios", "sampler"])
+    print("RMSE over {} replications".format(n_reps))
+    print(rmse)
+    print("Variance reduction factor of Sobol over plain Monte Carlo (paths saved for the same error)")
+    print((rmse.xs("pseudo", level="sampler")/rmse.xs("sobol", level="sampler"))**2)
@@ -1,9 +1,19 @@
 import pandas as pd
 import numpy as np
 import math
+import os
+import hashlib
+import functools
+import itertools
+import json
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing.shared_memory import SharedMemory
 import statsmodels.api as sm
-from scipy.stats import norm, jarque_bera
+from numpy.lib.stride_tricks import sliding_window_view
+from scipy.stats import norm, jarque_bera, qmc
 from scipy.optimize import minimize
+from scipy.linalg import cho_factor, cho_solve
 import matplotlib.pyplot as plt
 
 def annualize_rets(r, periods_per_year):
@@ -64,6 +74,38 @@ def weight_ew(r, cap_weights=None, max_cw_mult=None, microcap_threshold=None, **
             ew = ew/ew.sum() #reweight
     return ew
 
+
+def window_starts(windows, starts=None):
+    """
+    Returns the positions of the windows to evaluate in a stack of windows, all of them if starts is None
+    """
+    return np.arange(windows.shape[0]) if starts is None else np.asarray(starts)
+
+
+def weight_ew_stacked(windows, r, starts=None, cap_weights=None, max_cw_mult=None, microcap_threshold=None, **kwargs):
+    """
+    Stacked version of weight_ew: returns an n_starts x N array with the EW weights of the windows in starts
+    windows is the n_windows x W x N stack returned by rolling_windows, r the DataFrame it was taken from
+    and starts the positions of the windows to evaluate (all of them if None)
+    """
+    starts = window_starts(windows, starts)
+    n = windows.shape[2]
+    ew = np.full((len(starts), n), 1/n)
+    if cap_weights is not None:
+        cw = cap_weights.loc[r.index[starts], r.columns].values # starting cap weights
+        ## exclude microcaps
+        if microcap_threshold is not None and microcap_threshold > 0:
+            ew[cw < microcap_threshold] = 0
+            ew = ew/ew.sum(axis=1, keepdims=True)
+        #limit weight to a multiple of capweight
+        if max_cw_mult is not None and max_cw_mult > 0:
+            ew = np.minimum(ew, cw*max_cw_mult)
+            ew = ew/ew.sum(axis=1, keepdims=True) #reweight
+    return ew
+
+weight_ew.stacked = weight_ew_stacked
+
+
 def weight_cw(r, cap_weights, **kwargs):
     """
     Returns the weights of the CW portfolio based on the time series of capweights
@@ -72,37 +114,536 @@ def weight_cw(r, cap_weights, **kwargs):
     return w/w.sum()
 
 
-def sample_cov(r, **kwargs):
+def weight_cw_stacked(windows, r, cap_weights, starts=None, **kwargs):
+    """
+    Stacked version of weight_cw: returns an n_starts x N array with the CW weights of the windows in starts
+    """
+    starts = window_starts(windows, starts)
+    w = cap_weights.loc[r.index[starts+1]]
+    w = w.divide(w.sum(axis=1), axis="rows")
+    return w.reindex(columns=r.columns).values
+
+weight_cw.stacked = weight_cw_stacked
+
+
+# number of consecutive windows over which a RollingCov is rolled before being recomputed in full
+ROLLING_BLOCK = 256
+
+
+class RollingCov:
+    """
+    Sample covariance of a window of returns that is updated one row at a time.
+    Keeps the mean and the sum of cross products of the deviations from the mean (Welford)
+    so that adding or removing a row is a rank-one update costing O(N^2) instead of O(W*N^2)
+    The covariance, correlations and volatilities are computed once per window and shared by all their readers
+    """
+
+    def __init__(self, r=None, columns=None):
+        """
+        :param r: optional T x N DataFrame or array of returns to start the window with
+        :param columns: labels of the N assets, used to return DataFrames (taken from r if it is a DataFrame)
+        """
+        if columns is None and isinstance(r, pd.DataFrame):
+            columns = r.columns
+        self.columns = columns
+        self.n = 0
+        self.mean = None
+        self.m2 = None
+        self._estimates = {}
+        if r is not None:
+            for x in np.asarray(r, dtype=float):
+                self.add(x)
+
+    def add(self, x):
+        """ Adds a row of returns to the window """
+        x = np.asarray(x, dtype=float)
+        if self.n == 0:
+            self.mean = np.zeros_like(x)
+            self.m2 = np.zeros((x.shape[0], x.shape[0]))
+        self._estimates.clear()
+        self.n += 1
+        delta = x - self.mean
+        self.mean += delta/self.n
+        self.m2 += np.outer(delta, delta)*((self.n-1)/self.n)
+
+    def remove(self, x):
+        """ Removes a row of returns that was previously added to the window """
+        x = np.asarray(x, dtype=float)
+        self._estimates.clear()
+        if self.n <= 1:
+            self.n = 0
+            self.mean = np.zeros_like(x)
+            self.m2 = np.zeros((x.shape[0], x.shape[0]))
+            return
+        delta = x - self.mean
+        self.n -= 1
+        self.mean -= delta/self.n
+        self.m2 -= np.outer(delta, delta)*((self.n+1)/self.n)
+
+    def roll(self, x_in, x_out):
+        """ Moves the window forward by one row: adds x_in and removes x_out """
+        self.add(x_in)
+        self.remove(x_out)
+
+    def _frame(self, x):
+        if self.columns is None:
+            return x
+        return pd.DataFrame(x, index=self.columns, columns=self.columns)
+
+    def cov(self, ddof=1):
+        """ Returns the sample covariance of the current window """
+        if ("cov", ddof) not in self._estimates:
+            self._estimates["cov", ddof] = self._frame(self.m2/(self.n-ddof))
+        return self._estimates["cov", ddof]
+
+    def std(self, ddof=1):
+        """ Returns the sample standard deviations of the current window """
+        if ("std", ddof) not in self._estimates:
+            sd = np.sqrt(np.diag(self.m2)/(self.n-ddof))
+            self._estimates["std", ddof] = sd if self.columns is None else pd.Series(sd, index=self.columns)
+        return self._estimates["std", ddof]
+
+    def corr(self):
+        """ Returns the sample correlation matrix of the current window """
+        if "corr" not in self._estimates:
+            sd = np.sqrt(np.diag(self.m2))
+            self._estimates["corr"] = self._frame(self.m2/np.outer(sd, sd))
+        return self._estimates["corr"]
+
+
+class EstimatorCache:
+    """
+    Bounded LRU cache for the results of estimators such as sample_cov, cc_cov, shrinkage_cov or annualize_rets
+    Results are keyed on the estimator, its arguments and a cheap fingerprint of the returns (index bounds,
+    shape and a hash of the data), and stored as ndarrays. See cached() to memoise an estimator
+    """
+
+    # keyword arguments that carry state but do not change the result of an estimator
+    ignored_kwargs = ("rolling_cov", "ctx", "sample")
+
+    def __init__(self, maxsize=256):
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self._results = OrderedDict()
+
+    @staticmethod
+    def fingerprint(r):
+        """ Returns a fingerprint of a Series or DataFrame of returns: index bounds, shape and a hash of the data """
+        values = np.ascontiguousarray(r.values if isinstance(r, (pd.Series, pd.DataFrame)) else r)
+        digest = hashlib.blake2b(values.tobytes(), digest_size=16)
+        labels = (r.index[0], r.index[-1]) if isinstance(r, (pd.Series, pd.DataFrame)) and len(r) > 0 else ()
+        if isinstance(r, pd.DataFrame):
+            digest.update(repr(tuple(r.columns)).encode())
+        return labels + (values.shape, values.dtype.str, digest.hexdigest())
+
+    def key(self, estimator, r, args, kwargs):
+        """ Returns the cache key of a call, or None if its arguments cannot be hashed """
+        kwargs = tuple(sorted((k, v) for k, v in kwargs.items() if k not in self.ignored_kwargs))
+        key = (estimator, self.fingerprint(r), args, kwargs)
+        try:
+            hash(key)
+        except TypeError:
+            return None
+        return key
+
+    def get(self, key):
+        """ Returns the cached result for key, or None """
+        entry = self._results.get(key)
+        if entry is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self._results.move_to_end(key)
+        kind, values, index, columns = entry
+        if kind == "DataFrame":
+            return pd.DataFrame(values.copy(), index=index, columns=columns)
+        if kind == "Series":
+            return pd.Series(values.copy(), index=index, name=columns)
+        return values.copy() if kind == "ndarray" else values[()]
+
+    def put(self, key, result):
+        """ Stores the result for key, evicting the least recently used results beyond maxsize """
+        if isinstance(result, pd.DataFrame):
+            entry = ("DataFrame", result.values.copy(), result.index, result.columns)
+        elif isinstance(result, pd.Series):
+            entry = ("Series", result.values.copy(), result.index, result.name)
+        elif isinstance(result, np.ndarray):
+            entry = ("ndarray", result.copy(), None, None)
+        else:
+            entry = ("scalar", np.asarray(result), None, None)
+        self._results[key] = entry
+        self._results.move_to_end(key)
+        while len(self._results) > self.maxsize:
+            self._results.popitem(last=False)
+
+    def clear(self):
+        """ Empties the cache and resets the statistics """
+        self._results.clear()
+        self.hits = 0
+        self.misses = 0
+
+    def stats(self):
+        """ Returns the hit/miss statistics of the cache """
+        calls = self.hits + self.misses
+        return {"hits": self.hits, "misses": self.misses, "size": len(self._results),
+                "maxsize": self.maxsize, "hit_rate": self.hits/calls if calls > 0 else np.nan}
+
+
+estimator_cache = EstimatorCache()
+
+
+class CachedEstimator:
+    """
+    An estimator whose results are memoised in an EstimatorCache, see cached()
+    Unlike a closure it can be pickled, e.g. to be sent to the worker processes of a parallel backtest
+    (each worker then gets its own copy of the cache)
+    It has no stacked version, so that the backtests call it once per window and go through the cache
+    """
+
+    def __init__(self, estimator, cache):
+        # copy the name and docstring only, the attributes of estimator include its uncached stacked version
+        functools.update_wrapper(self, estimator, updated=())
+        self.uses_sample_cov = getattr(estimator, "uses_sample_cov", False)
+        self.estimator = estimator
+        self.cache = cache
+
+    def __call__(self, r, *args, **kwargs):
+        key = self.cache.key(self.estimator, r, args, kwargs)
+        if key is None:
+            return self.estimator(r, *args, **kwargs)
+        result = self.cache.get(key)
+        if result is None:
+            result = self.estimator(r, *args, **kwargs)
+            self.cache.put(key, result)
+        return result
+
+
+def cached(estimator, cache=None):
+    """
+    Returns a memoised version of estimator, e.g. backtest_ws(r, weighting=weight_gmv, cov_estimator=cached(cc_cov))
+    Results are stored in cache, by default the shared module level estimator_cache, so separate runs over the
+    same windows (other strategies, reruns, parameter sweeps) reuse them. Calls with unhashable arguments
+    are not cached. The memoised estimator has no stacked version: the backtests call it once per window
+    """
+    return CachedEstimator(estimator, estimator_cache if cache is None else cache)
+
+
+def sample_cov(r, rolling_cov=None, **kwargs):
     """
     Returns the sample covariance of the supplied returns
+    If a RollingCov over the same window is supplied, the covariance is read from it
     """
+    if rolling_cov is not None:
+        return rolling_cov.cov()
     return r.cov()
 
 
-def weight_gmv(r, cov_estimator=sample_cov, **kwargs):
+def rolling_anchors(starts, window):
+    """
+    Returns, for each position in starts, the position of the window where a RollingCov walking the windows in
+    starts in order (see rolling_covs) was last recomputed in full
+    """
+    anchors = np.empty(len(starts), dtype=np.int64)
+    anchor, prev = None, None
+    for i, start in enumerate(starts):
+        if prev is None or start - prev >= window or start//ROLLING_BLOCK != prev//ROLLING_BLOCK:
+            anchor = start
+        anchors[i] = anchor
+        prev = start
+    return anchors
+
+
+def rolling_covs(windows, starts, anchor=None, columns=None):
+    """
+    Yields a RollingCov of each window in starts, taken from the stack of windows returned by rolling_windows
+    The first window is computed in full, the next ones by rolling the RollingCov forward one row at a time
+    (or in full again when that is cheaper, i.e. when the next window does not overlap the previous one)
+    The RollingCov is also recomputed in full at the start of every block of ROLLING_BLOCK windows, which bounds
+    the accumulation of rounding errors. anchor is the position where a walk over earlier windows was last
+    recomputed in full (see rolling_anchors), so that a walk over a chunk of the windows resumes it exactly
+    """
+    window = windows.shape[1]
+    rolling_cov, prev = None, None
+    if anchor is not None and len(starts) > 0 and anchor != starts[0]:
+        # resume the walk: roll from the anchor to the first window, which then continues the same RollingCov
+        rolling_cov, prev = RollingCov(windows[anchor], columns=columns), starts[0]
+        for k in range(anchor+1, prev+1):
+            rolling_cov.roll(windows[k, -1], windows[k-1, 0])
+    for start in starts:
+        if rolling_cov is None or start - prev >= window or start//ROLLING_BLOCK != prev//ROLLING_BLOCK:
+            rolling_cov = RollingCov(windows[start], columns=columns)
+        else:
+            for k in range(prev+1, start+1):
+                rolling_cov.roll(windows[k, -1], windows[k-1, 0])
+        prev = start
+        yield rolling_cov
+
+
+def sample_cov_stacked(windows, starts=None, sample=None, anchor=None, **kwargs):
+    """
+    Stacked version of sample_cov: returns the n_starts x N x N sample covariances of the windows in starts,
+    rolling a RollingCov from one window to the next (see rolling_covs, and anchor there)
+    If the stacked sample covariances were already computed (e.g. by backtest_strategies) they are passed as sample
+    """
+    if sample is not None:
+        return sample
+    starts = window_starts(windows, starts)
+    covs = np.empty((len(starts), windows.shape[2], windows.shape[2]))
+    for i, rolling_cov in enumerate(rolling_covs(windows, starts, anchor=anchor)):
+        covs[i] = rolling_cov.cov()
+    return covs
+
+sample_cov.stacked = sample_cov_stacked
+sample_cov.uses_sample_cov = True
+
+
+def weight_gmv(r, cov_estimator=sample_cov, ctx=None, **kwargs):
     """
     Produces the weights of the GMV portfolio given a covariance matrix of the returns
     """
     est_cov = cov_estimator(r, **kwargs)
-    return gmv(est_cov)
+    return gmv(est_cov, ctx=ctx)
+
+
+def weight_gmv_stacked(windows, r, cov_estimator=sample_cov, ctx=None, **kwargs):
+    """
+    Stacked version of weight_gmv: returns an n_starts x N array with the GMV weights of the windows in starts
+    """
+    est_covs = cov_estimator.stacked(windows, **kwargs)
+    return np.array([gmv(est_cov, ctx=ctx) for est_cov in est_covs])
+
+weight_gmv.stacked = weight_gmv_stacked
+weight_gmv.uses_sample_cov = True
 
-def backtest_ws(r, estimation_window=60, weighting=weight_ew, verbose=False, **kwargs):
+
+def rolling_windows(values, window):
+    """
+    Returns a zero-copy view of all the windows of "window" consecutive rows of the T x N array "values"
+    as an array of shape (T-window+1) x window x N
+    """
+    return sliding_window_view(values, window, axis=0).swapaxes(1, 2)
+
+
+def stacked_weighting(weighting, **kwargs):
+    """
+    Returns the stacked version of the weighting scheme, i.e. a function that takes the whole
+    stack of windows at once, or None if the weighting (or its cov_estimator) does not have one
+    Stacked versions are attached to the weighting function as its "stacked" attribute
+    """
+    cov_estimator = kwargs.get("cov_estimator")
+    if cov_estimator is not None and getattr(cov_estimator, "stacked", None) is None:
+        return None
+    return getattr(weighting, "stacked", None)
+
+
+def sample_cov_weighting(weighting, **kwargs):
+    """
+    Returns True if the weighting reads the sample covariance shared by the strategies of a backtest, i.e. the
+    RollingCov of its window passed as rolling_cov=, or for stacked weightings the covariances of all the windows
+    passed as sample=. Weightings and covariance estimators opt in by setting their "uses_sample_cov" attribute
+    to True, a weighting that takes a cov_estimator only passes it on if the estimator opted in too
+    """
+    if not getattr(weighting, "uses_sample_cov", False):
+        return False
+    cov_estimator = kwargs.get("cov_estimator")
+    return cov_estimator is None or getattr(cov_estimator, "uses_sample_cov", False)
+
+
+def rebalance_dates(dates, rebalance=None):
+    """
+    Returns a boolean array that is True for the dates on which the portfolio is rebalanced. rebalance can be:
+        None: every period
+        an int k: every k periods
+        a frequency string such as "Q" or "Y": on the first date of every calendar period
+        a list of dates: on those dates
+    The first date is always a rebalance date
+    """
+    if rebalance is None:
+        mask = np.ones(len(dates), dtype=bool)
+    elif isinstance(rebalance, (int, np.integer)):
+        mask = np.arange(len(dates)) % rebalance == 0
+    elif isinstance(rebalance, str):
+        periods = dates.asfreq(rebalance) if isinstance(dates, pd.PeriodIndex) else dates.to_period(rebalance)
+        mask = np.ones(len(dates), dtype=bool)
+        mask[1:] = periods[1:] != periods[:-1]
+    else:
+        rebalance = pd.Index(rebalance)
+        if rebalance.dtype != dates.dtype:
+            rebalance = rebalance.astype(dates.dtype)
+        mask = dates.isin(rebalance)
+    if len(mask) > 0:
+        mask[0] = True
+    return mask
+
+
+def drift_weights(weights, r, rebalance):
+    """
+    Returns the T x N array of weights held over each period, given the weights set on the rebalance dates
+    weights is the n_rebalance x N array of weights set on the dates where the boolean array rebalance is True
+    and r the T x N array of asset returns over the same dates. Between two rebalance dates the weights
+    drift with the returns of the assets, for all periods at once
+    """
+    weights = np.asarray(weights, dtype=float)
+    r = np.nan_to_num(np.asarray(r, dtype=float))
+    holding = np.cumsum(rebalance) - 1
+    # log of the growth of a dollar invested in each asset since the start of the backtest
+    log_growth = np.zeros_like(r)
+    np.cumsum(np.log1p(r[:-1]), axis=0, out=log_growth[1:])
+    starts = np.flatnonzero(rebalance)
+    growth = np.exp(log_growth - log_growth[starts][holding])
+    drifted = weights[holding]*growth
+    return drifted*(np.nansum(weights[holding], axis=1)/np.nansum(drifted, axis=1))[:, None]
+
+
+def backtest_ws(r, estimation_window=60, weighting=weight_ew, verbose=False, rebalance=None, n_jobs=1, executor=None,
+                **kwargs):
     """
     Backtests a given weighting scheme, given some parameters:
     r : asset returns to use to build the portfolio
     estimation_window: the window to use to estimate parameters
     weighting: the weighting scheme to use, must be a function that takes "r", and a variable number of keyword-value arguments
-    """
-    n_periods = r.shape[0]
-    # return windows
-    windows = [(start, start+estimation_window) for start in range(n_periods-estimation_window)]
-    weights = [weighting(r.iloc[win[0]:win[1]], **kwargs) for win in windows]
-    # convert List of weights to DataFrame
-    weights = pd.DataFrame(weights, index=r.iloc[estimation_window:].index, columns=r.columns)
-    returns = (weights * r).sum(axis="columns",  min_count=1) #mincount is to generate NAs if all inputs are NAs
+    rebalance: the rebalance schedule (see rebalance_dates), by default every period. The weights are only
+    computed on rebalance dates and drift with the asset returns in between
+    n_jobs/executor: spread the windows over n_jobs processes, or over the supplied executor (see backtest_strategies)
+    If the weighting has a stacked version (see stacked_weighting) and r has no missing values, all the windows
+    are evaluated at once on zero-copy views of the returns, otherwise weighting is called once per window
+    Pass ctx=OptimizerContext() to start the optimizer of each window from the solution of the previous one
+    """
+    strategies = {"returns": dict(kwargs, weighting=weighting)}
+    returns = backtest_strategies(r, strategies, estimation_window=estimation_window, rebalance=rebalance,
+                                  n_jobs=n_jobs, executor=executor)["returns"]
+    returns.name = None
     return returns
 
 
+def strategy_weights(r, strategies, estimation_window, starts, anchor=None):
+    """
+    Returns a dict of name -> len(starts) x N array with the weights of each strategy (see backtest_strategies)
+    for the windows of r that start at the positions in starts
+    anchor resumes the RollingCov of an earlier walk over the windows (see rolling_covs and parallel_strategy_weights)
+    """
+    n_windows = r.shape[0]-estimation_window
+    has_na = r.isna().values.any()
+    specs, stacked = {}, {}
+    for name, spec in strategies.items():
+        spec = dict(spec)
+        weighting = spec.pop("weighting", weight_ew)
+        specs[name] = (weighting, spec)
+        kernel = stacked_weighting(weighting, **spec)
+        if kernel is not None and n_windows > 0 and not has_na:
+            stacked[name] = kernel
+
+    weights = {}
+    if stacked:
+        windows = rolling_windows(r.values, estimation_window)[:n_windows]
+        # the sample covariances are only computed if a strategy reads them (e.g. not for EW or CW)
+        sharing = {name: sample_cov_weighting(specs[name][0], **specs[name][1]) for name in stacked}
+        sample = sample_cov_stacked(windows, starts=starts, anchor=anchor) if any(sharing.values()) else None
+        for name, kernel in stacked.items():
+            if sharing[name]:
+                weights[name] = kernel(windows, r, starts=starts, sample=sample, **specs[name][1])
+            else:
+                weights[name] = kernel(windows, r, starts=starts, **specs[name][1])
+    looped = [name for name in specs if name not in stacked]
+    if looped:
+        for name in looped:
+            weights[name] = []
+        rolling = {name: sample_cov_weighting(specs[name][0], **specs[name][1]) for name in looped}
+        if not has_na and any(rolling.values()):
+            walk = rolling_covs(rolling_windows(r.values, estimation_window), starts, anchor=anchor, columns=r.columns)
+        else:
+            walk = itertools.repeat(None)
+        for start, rolling_cov in zip(starts, walk):
+            window = r.iloc[start:start+estimation_window]
+            for name in looped:
+                weighting, spec = specs[name]
+                if rolling[name]:
+                    weights[name].append(weighting(window, rolling_cov=rolling_cov, **spec))
+                else:
+                    weights[name].append(weighting(window, **spec))
+    return {name: pd.DataFrame(weights[name], columns=r.columns).values for name in specs}
+
+
+def _strategy_weights_worker(shm_name, shape, dtype, index, columns, strategies, estimation_window, starts, anchor):
+    """
+    Runs strategy_weights in a worker process on returns stored in the shared memory block shm_name
+    """
+    shm = SharedMemory(name=shm_name)
+    try:
+        r = pd.DataFrame(np.ndarray(shape, dtype=dtype, buffer=shm.buf), index=index, columns=columns, copy=False)
+        weights = strategy_weights(r, strategies, estimation_window, starts, anchor=anchor)
+        del r
+    finally:
+        shm.close()
+    return weights
+
+
+def parallel_strategy_weights(r, strategies, estimation_window, starts, n_jobs=-1, executor=None):
+    """
+    Same as strategy_weights, with the windows split in chunks that are run in parallel over n_jobs processes
+    (all the cores if -1) or on the supplied executor. The returns are passed to the workers through shared memory
+    Each chunk resumes the RollingCov of the serial walk from the window where it was last recomputed in full
+    (see rolling_anchors) and the results are returned in order, so they do not depend on the number of workers and
+    match the serial path exactly, as long as the strategies do not carry state from one window to the next
+    (e.g. an OptimizerContext, which is copied to each chunk)
+    """
+    n_jobs = os.cpu_count() if n_jobs is None or n_jobs < 1 else n_jobs
+    values = np.ascontiguousarray(r.values, dtype=float)
+    # split the windows into about 4 chunks per worker, each chunk resumes the RollingCov of the serial walk
+    # from the window where it was last recomputed in full
+    n_chunks = max(min(len(starts), 4*n_jobs), 1)
+    chunks = [chunk for chunk in np.array_split(np.asarray(starts, dtype=np.int64), n_chunks) if len(chunk) > 0]
+    first = np.cumsum([0] + [len(chunk) for chunk in chunks[:-1]])
+    anchors = rolling_anchors(starts, estimation_window)[first] if len(starts) > 0 else []
+
+    shm = SharedMemory(create=True, size=max(values.nbytes, 1))
+    try:
+        np.ndarray(values.shape, dtype=values.dtype, buffer=shm.buf)[:] = values
+        args = (shm.name, values.shape, values.dtype, r.index, r.columns, strategies, estimation_window)
+        pool = ProcessPoolExecutor(max_workers=n_jobs) if executor is None else executor
+        try:
+            results = list(pool.map(_strategy_weights_worker,
+                                    *zip(*[args + (chunk, anchor) for chunk, anchor in zip(chunks, anchors)])))
+        finally:
+            if executor is None:
+                pool.shutdown()
+    finally:
+        shm.close()
+        shm.unlink()
+    return {name: np.concatenate([res[name] for res in results]) for name in strategies}
+
+
+def backtest_strategies(r, strategies, estimation_window=60, rebalance=None, n_jobs=1, executor=None):
+    """
+    Backtests several weighting schemes over the same returns and windows, walking the windows only once
+    strategies is a dict of name -> keyword arguments of backtest_ws for that strategy, e.g.
+        {"EW": dict(weighting=weight_ew), "GMV-Shrink 0.5": dict(weighting=weight_gmv, cov_estimator=shrinkage_cov, delta=0.5)}
+    The sample covariances of the windows are estimated once and shared by all the strategies: the stacked
+    weightings that read them (see sample_cov_weighting) receive them as sample=, the others that read them a RollingCov
+    (with cached covariance, correlations and volatilities) as rolling_cov= along with the window of returns.
+    With n_jobs other than 1, or an executor, the windows are spread over processes (see parallel_strategy_weights),
+    the weighting functions and their arguments must then be picklable
+    Returns a DataFrame with the returns of each strategy in a column, the same as calling backtest_ws for each one
+    """
+    dates = r.index[estimation_window:]
+    rebalance = rebalance_dates(dates, rebalance)
+    starts = np.flatnonzero(rebalance)
+    if (n_jobs == 1 and executor is None) or len(starts) == 0:
+        weights = strategy_weights(r, strategies, estimation_window, starts)
+    else:
+        weights = parallel_strategy_weights(r, strategies, estimation_window, starts, n_jobs=n_jobs, executor=executor)
+
+    btr = {}
+    for name in strategies:
+        w = weights[name]
+        if not rebalance.all():
+            w = drift_weights(w, r.iloc[estimation_window:], rebalance)
+        w = pd.DataFrame(w, index=dates, columns=r.columns)
+        btr[name] = (w * r).sum(axis="columns", min_count=1) #mincount is to generate NAs if all inputs are NAs
+    return pd.DataFrame(btr, index=r.index)
+
+
 def bl(w_prior, sigma_prior, p, q,
                 omega=None,
                 delta=2.5, tau=.02):
@@ -200,7 +741,9 @@ def bt_mix(r1, r2, allocator, **kwargs):
     Runs a back test (simulation) of allocating between a two sets of returns
     r1 and r2 are T x N DataFrames or returns where T is the time step index and N is the number of scenarios.
     allocator is a function that takes two sets of returns and allocator specific parameters, and produces
-    an allocation to the first portfolio (the rest of the money is invested in the GHP) as a T x 1 DataFrame
+    an allocation to the first portfolio (the rest of the money is invested in the GHP) that broadcasts
+    against the returns: a scalar, a T x 1 (a Series indexed by time is taken as T x 1), 1 x N or T x N
+    array or DataFrame, so that static allocations never have to be repeated over the N scenarios
     Returns a T x N DataFrame of the resulting N portfolio scenarios
 
     :param allocator: Executable that accepts r1, r2, kwargs and returns weights
@@ -208,70 +751,226 @@ def bt_mix(r1, r2, allocator, **kwargs):
     if not r1.shape == r2.shape:
         raise ValueError("r1 and r2 should have the same shape")
     weights = allocator(r1, r2, **kwargs)
-    if not weights.shape == r1.shape:
+    if isinstance(weights, pd.Series):
+        weights = weights.to_frame()
+    weights = np.asarray(weights, dtype=np.float64)
+    try:
+        shape = np.broadcast_shapes(weights.shape, r1.shape)
+    except ValueError:
+        shape = None
+    if weights.ndim > 2 or shape != r1.shape:
         raise ValueError("Allocator returned weights with a different shape than the returns")
-    r_mix = weights*r1 + (1-weights)*r2
-    return r_mix
+    r_mix = weights*np.asarray(r1, dtype=np.float64) + (1-weights)*np.asarray(r2, dtype=np.float64)
+    return pd.DataFrame(r_mix, index=r1.index, columns=r1.columns)
 
 
-def cc_cov(r, **kwargs):
+def bt_mix_sweep(r1, r2, allocator, grid, **kwargs):
+    """
+    Runs bt_mix for every combination of the allocator parameters in grid, in a single recursion
+    grid is a dict of parameter name -> list of values (e.g. {"m": [1, 3, 5], "floor": [.75, .8]}),
+    the other kwargs are passed to the allocator unchanged
+    The allocator must have an array version attached as allocator.arrays (e.g. floor_allocator) which
+    accepts P x 1 parameter arrays and returns T x P x N weights
+    Returns a T x (P*N) DataFrame with MultiIndex columns (parameters..., scenario), so that
+    rets[(3, .75)] is the T x N bt_mix result for m=3, floor=.75 and terminal_stats(rets) has one
+    column per parameter point
+    """
+    if not r1.shape == r2.shape:
+        raise ValueError("r1 and r2 should have the same shape")
+    names = list(grid)
+    points = list(itertools.product(*grid.values()))
+    params = {name: np.array([point[i] for point in points], dtype=np.float64)[:, None]
+              for i, name in enumerate(names)}
+    r1_values = np.ascontiguousarray(r1, dtype=np.float64)
+    r2_values = np.ascontiguousarray(r2, dtype=np.float64)
+    weights = allocator.arrays(r1_values, r2_values, **kwargs, **params)
+    n_steps, n_scenarios = r1_values.shape
+    if not weights.shape == (n_steps, len(points), n_scenarios):
+        raise ValueError("Allocator returned weights with a different shape than the parameter grid")
+    r_mix = weights*r1_values[:, None, :] + (1-weights)*r2_values[:, None, :]
+    columns = pd.MultiIndex.from_tuples([point + (column,) for point in points for column in r1.columns],
+                                        names=names + [r1.columns.name or "scenario"])
+    return pd.DataFrame(r_mix.reshape(n_steps, -1), index=r1.index, columns=columns)
+
+
+def cc_cov(r, rolling_cov=None, **kwargs):
     """
     Estimates a covariance matrix by using the Elton/Gruber Constant Correlation model
+    If a RollingCov over the same window is supplied, the correlations and volatilities are read from it
     """
-    rhos = r.corr()
+    if rolling_cov is not None:
+        rhos, sd, columns = rolling_cov.corr(), rolling_cov.std(), rolling_cov.columns
+    else:
+        rhos, sd, columns = r.corr(), r.std(), r.columns
     n = rhos.shape[0]
     # this is a symmetric matrix with diagonals all 1 - so the mean correlation is ...
-    rho_bar = (rhos.values.sum()-n)/(n*(n-1))
+    rho_bar = (np.asarray(rhos).sum()-n)/(n*(n-1))
     ccor = np.full_like(rhos, rho_bar)
     np.fill_diagonal(ccor, 1.)
-    sd = r.std()
     ccov = ccor * np.outer(sd, sd)
 #     mh.corr2cov(ccor, sd)
-    return pd.DataFrame(ccov, index=r.columns, columns=r.columns)
+    return pd.DataFrame(ccov, index=columns, columns=columns)
 
 
-def cir(n_years=10, n_scenarios=1, a=0.05, b=0.03, sigma=0.05, steps_per_year=12, r_0=None):
+def cc_cov_stacked(windows, starts=None, sample=None, **kwargs):
+    """
+    Stacked version of cc_cov: returns the n_starts x N x N Constant Correlation covariances of the windows in starts
+    sample can be supplied if the stacked sample covariances are already known
+    """
+    if sample is None:
+        sample = sample_cov_stacked(windows, starts=starts)
+    n = sample.shape[1]
+    sd = np.sqrt(np.diagonal(sample, axis1=1, axis2=2))
+    sd_outer = sd[:, :, None]*sd[:, None, :]
+    rho_bar = ((sample/sd_outer).sum(axis=(1, 2))-n)/(n*(n-1))
+    ccor = np.broadcast_to(rho_bar[:, None, None], sample.shape).copy()
+    ccor[:, np.arange(n), np.arange(n)] = 1.
+    return ccor * sd_outer
+
+cc_cov.stacked = cc_cov_stacked
+cc_cov.uses_sample_cov = True
+
+
+def cir(n_years=10, n_scenarios=1, a=0.05, b=0.03, sigma=0.05, steps_per_year=12, r_0=None, method="euler",
+        as_frame=True, rng=None, antithetic=False, moment_matching=False, sampler="pseudo"):
     """
     Generate random interest rate evolution over time using the CIR model
     b and r_0 are assumed to be the annualized rates, not the short rate
     and the returned values are the annualized rates as well
-    """
+    method="euler" takes an Euler step of the short rate reflected at 0, method="exact" samples its exact
+    transition (a scaled noncentral chi-square) so that coarse grids, e.g. annual steps, stay exact
+    The prices of the zero coupon bond maturing at n_years use A and B precomputed once for the whole time grid
+    Returns the rates and prices as DataFrames, or as (n_steps+1) x n_scenarios arrays if as_frame is False
+    rng is a seed or numpy Generator (see as_generator), use generate_scenarios to split the scenarios over workers
+    antithetic, moment_matching and sampler apply to the normal shocks of the euler method (see normal_shocks)
+    """
+    random = as_generator(rng)
     if r_0 is None: r_0 = b
     r_0 = ann_to_inst(r_0)
     dt = 1 / steps_per_year
     num_steps = int(n_years * steps_per_year) + 1  # because n_years might be a float
 
-    shock = np.random.normal(0, scale=np.sqrt(dt), size=(num_steps, n_scenarios))
-    rates = np.empty_like(shock)
+    rates = np.empty((num_steps, n_scenarios))
     rates[0] = r_0
+    if method == "euler":
+        shock = np.sqrt(dt) * normal_shocks(random, (num_steps, n_scenarios), antithetic, moment_matching, sampler)
+        cir_euler_steps(rates, shock, a, b, sigma, dt)
+    elif method == "exact":
+        if antithetic or moment_matching or sampler != "pseudo":
+            raise ValueError("antithetic, moment_matching and sampler need the normal shocks of the euler method")
+        # r_t given r_s is c times a noncentral chi-square with df degrees of freedom and non-centrality nc
+        c = sigma ** 2 * (1 - math.exp(-a * dt)) / (4 * a)
+        df = 4 * a * b / sigma ** 2
+        decay = math.exp(-a * dt) / c
+        for step in range(1, num_steps):
+            rates[step] = c * random.noncentral_chisquare(df, rates[step - 1] * decay)
+    else:
+        raise ValueError(f"Unknown method {method}, expected 'euler' or 'exact'")
 
-    ## For Price Generation
-    h = math.sqrt(a ** 2 + 2 * sigma ** 2)
-    prices = np.empty_like(shock)
-
-    ####
-    def price(ttm, r):
-        _A = ((2 * h * math.exp((h + a) * ttm / 2)) / (2 * h + (h + a) * (math.exp(h * ttm) - 1))) ** (
-                    2 * a * b / sigma ** 2)
-        _B = (2 * (math.exp(h * ttm) - 1)) / (2 * h + (h + a) * (math.exp(h * ttm) - 1))
-        _P = _A * np.exp(-_B * r)
-        return _P
+    prices = cir_zc_prices(rates, n_years, a, b, sigma, steps_per_year)
+    rates = inst_to_ann(rates)
+    if not as_frame:
+        return rates, prices
+    rates = pd.DataFrame(data=rates, index=range(num_steps))
+    prices = pd.DataFrame(data=prices, index=range(num_steps))
+    return rates, prices
 
-    prices[0] = price(n_years, r_0)
-    ####
 
-    for step in range(1, num_steps):
+def cir_euler_steps(rates, shock, a, b, sigma, dt):
+    """
+    Fills the rows 1.. of the T x N array of short rates (row 0 holds r_0) in place with CIR Euler steps
+    reflected at 0, driven by the T x N normal shocks already scaled by sqrt(dt)
+    """
+    for step in range(1, len(rates)):
         r_t = rates[step - 1]
         d_r_t = a * (b - r_t) * dt + sigma * np.sqrt(r_t) * shock[step]
         rates[step] = abs(r_t + d_r_t)
-        # generate prices at time t as well ...
-        prices[step] = price(n_years - step * dt, rates[step])
+    return rates
 
-    rates = pd.DataFrame(data=inst_to_ann(rates), index=range(num_steps))
-    ### for prices
-    prices = pd.DataFrame(data=prices, index=range(num_steps))
-    ###
-    return rates, prices
+
+def cir_zc_prices(rates, n_years, a, b, sigma, steps_per_year, out=None):
+    """
+    Prices of the zero coupon bond maturing at n_years under the CIR model, given the T x N short rates
+    on the time grid, P(t) = A(ttm) * exp(-B(ttm) * r_t) with A and B computed once for every step of the grid
+    """
+    dt = 1 / steps_per_year
+    h = math.sqrt(a ** 2 + 2 * sigma ** 2)
+    ttm = n_years - np.arange(len(rates)) * dt
+    exp_h = np.exp(h * ttm)
+    _A = ((2 * h * np.exp((h + a) * ttm / 2)) / (2 * h + (h + a) * (exp_h - 1))) ** (2 * a * b / sigma ** 2)
+    _B = (2 * (exp_h - 1)) / (2 * h + (h + a) * (exp_h - 1))
+    prices = np.multiply(-_B[:, None], rates, out=out)
+    np.exp(prices, out=prices)
+    prices *= _A[:, None]
+    return prices
+
+
+def correlated_scenarios(n_years=10, n_scenarios=1000, mu=0.07, sigma=0.15, corr=None, steps_per_year=12, s_0=100.0,
+                         cir_params=None, names=None, rng=None, sampler="pseudo", antithetic=False,
+                         moment_matching=False, block_size=None, out=None):
+    """
+    Joint scenarios of K correlated GBM assets (as in gbm) and optionally of CIR short rates (as in cir)
+    All the factors are driven by one T x N x F tensor of normal shocks correlated with the Cholesky factor of corr,
+    the F x F correlation matrix of the K assets followed by the rates (identity by default)
+    :param mu, sigma, s_0: annualized drifts, volatilities and initial values of the K assets (scalars or length K)
+    :param cir_params: dict of cir parameters (a, b, sigma, r_0) to add the short rates as the last factor
+    :param names: names of the K assets, 0..K-1 by default
+    :param rng, sampler, antithetic, moment_matching: see gbm and normal_shocks
+    :param block_size: number of scenarios generated at once, which bounds the temporaries (the shock tensor) for
+    large N; the blocks draw one after the other from rng so the paths depend on block_size
+    :param out: optional (F+1) x T x N float64 array to write into, e.g. a memmap
+    Returns a dict of T x N arrays: the prices of each asset, and "rates" (annualized) and "zc_prices" of the
+    zero coupon bond maturing at n_years if cir_params is given. They are contiguous views into one array, no copies
+    """
+    random = as_generator(rng)
+    mu, sigma, s_0 = np.broadcast_arrays(*(np.atleast_1d(np.asarray(x, dtype=np.float64)) for x in (mu, sigma, s_0)))
+    n_assets = len(mu)
+    n_factors = n_assets + (cir_params is not None)
+    names = list(range(n_assets)) if names is None else list(names)
+    corr = np.eye(n_factors) if corr is None else np.asarray(corr, dtype=np.float64)
+    if corr.shape != (n_factors, n_factors) or len(names) != n_assets:
+        raise ValueError("corr must be F x F and names of length K, for K assets and F factors (the rates are last)")
+    chol = np.linalg.cholesky(corr)
+    dt = 1/steps_per_year
+    n_steps = int(n_years*steps_per_year) + 1
+    n_arrays = n_assets + 2*(cir_params is not None)
+    if out is None:
+        out = np.empty((n_arrays, n_steps, n_scenarios))
+    elif out.shape != (n_arrays, n_steps, n_scenarios):
+        raise ValueError(f"out must have the shape {(n_arrays, n_steps, n_scenarios)}")
+    if cir_params is not None:
+        cir_params = dict({"a": 0.05, "b": 0.03, "sigma": 0.05}, **cir_params)
+        r_0 = ann_to_inst(cir_params.get("r_0") if cir_params.get("r_0") is not None else cir_params["b"])
+
+    block_size = block_size or max(n_scenarios, 1)
+    for start in range(0, n_scenarios, block_size):
+        cols = slice(start, min(start + block_size, n_scenarios))
+        shock = normal_shocks(random, (n_steps, cols.stop - start, n_factors), antithetic, moment_matching, sampler)
+        if n_factors > 1:
+            shock = shock @ chol.T
+        for k in range(n_assets):
+            # prices as in gbm: s_0 times the cumulative product of normal gross returns
+            prices = out[k, :, cols]
+            np.multiply((sigma[k]*np.sqrt(dt)), shock[..., k], out=prices)
+            prices += (1+mu[k])**dt
+            prices[0] = 1
+            np.cumprod(prices, axis=0, out=prices)
+            prices *= s_0[k]
+        if cir_params is not None:
+            rates = out[n_assets, :, cols]
+            rates[0] = r_0
+            cir_euler_steps(rates, np.sqrt(dt)*shock[..., n_assets], cir_params["a"], cir_params["b"],
+                            cir_params["sigma"], dt)
+            cir_zc_prices(rates, n_years, cir_params["a"], cir_params["b"], cir_params["sigma"], steps_per_year,
+                          out=out[n_assets+1, :, cols])
+            np.expm1(rates, out=rates)
+        del shock
+
+    scenarios = {name: out[k] for k, name in enumerate(names)}
+    if cir_params is not None:
+        scenarios["rates"] = out[n_assets]
+        scenarios["zc_prices"] = out[n_assets+1]
+    return scenarios
 
 
 def compound_fast(r):
@@ -297,6 +996,86 @@ def drawdown(return_series: pd.Series):
                          "Drawdown": drawdowns})
 
 
+class CPPIAllocator:
+    """
+    Streaming CPPI-style allocator between a PSP (risky asset) and a GHP (safe asset).
+    Keeps only the current state of each scenario (account value, peak, floor, weight) so that it can be
+    driven one period at a time by a live feed of returns, or over a full history by run_allocator
+    The floor is either start*floor discounted by the price of a zero coupon bond (floor_allocator, run_cppi)
+    or (1-maxdd) times the previous peak of the account value (drawdown_allocator, run_cppi with drawdown)
+    m, floor and maxdd can be arrays that broadcast against the N scenarios (see bt_mix_sweep)
+    """
+
+    def __init__(self, m=3, floor=0.8, maxdd=None, start=1.0, zc_price=1.0, n_scenarios=1):
+        """
+        :param zc_price: price of the zero coupon bond used to discount the floor for the first period
+        :param n_scenarios: number of scenarios run side by side
+        """
+        self.m = m
+        self.floor = floor
+        self.maxdd = maxdd
+        self.start = start
+        self.zc_price = zc_price
+        shape = np.broadcast_shapes(np.shape(m), np.shape(floor), np.shape(maxdd), np.shape(zc_price), (n_scenarios,))
+        self.account_value = np.full(shape, float(start))
+        self.peak_value = self.account_value.copy()
+        self._allocate()
+
+    def _allocate(self):
+        if self.maxdd is None:
+            self.floor_value = self.start*self.floor*self.zc_price ## PV of Floor assuming today's rates and flat YC
+        else:
+            self.floor_value = (1-self.maxdd)*self.peak_value ### Floor is based on Prev Peak
+        self.cushion = (self.account_value - self.floor_value)/self.account_value
+        self.weight = np.clip(self.m*self.cushion, 0, 1) # same as applying min and max
+        return self.weight
+
+    def step(self, risky_r, safe_r, zc_price=None):
+        """
+        Grows the account over one period at the current weights, given the returns of the PSP and GHP
+        over that period, and returns the weights in the PSP for the next period
+        zc_price is the new price of the zero coupon bond (the previous price is kept if it is None)
+        """
+        psp_alloc = self.account_value*self.weight
+        ghp_alloc = self.account_value*(1-self.weight)
+        self.account_value = psp_alloc*(1+risky_r) + ghp_alloc*(1+safe_r)
+        np.maximum(self.peak_value, self.account_value, out=self.peak_value)
+        if zc_price is not None:
+            self.zc_price = zc_price
+        return self._allocate()
+
+    def checkpoint(self):
+        """ Returns the parameters and state of the allocator as a dict of copies, which restore accepts """
+        return {"m": self.m, "floor": self.floor, "maxdd": self.maxdd, "start": self.start,
+                "zc_price": np.copy(self.zc_price), "account_value": self.account_value.copy(),
+                "peak_value": self.peak_value.copy(), "floor_value": np.copy(self.floor_value)}
+
+    @classmethod
+    def restore(cls, state):
+        """ Rebuilds an allocator from a checkpoint, it continues exactly where the checkpointed one was """
+        allocator = cls(m=state["m"], floor=state["floor"], maxdd=state["maxdd"], start=state["start"],
+                        zc_price=state["zc_price"], n_scenarios=np.shape(state["account_value"])[-1])
+        allocator.account_value = np.array(state["account_value"], dtype=np.float64)
+        allocator.peak_value = np.array(state["peak_value"], dtype=np.float64)
+        allocator._allocate()
+        return allocator
+
+
+def run_allocator(allocator, psp_r, ghp_r, zc_prices=None):
+    """
+    Drives a streaming allocator (e.g. CPPIAllocator) over T x N arrays of PSP and GHP returns
+    zc_prices are the T x N prices of the zero coupon bond at the start of each period, if the floor uses them
+    Returns a T x N (or T x P x N) float64 array of the weights in the PSP
+    """
+    n_steps = len(psp_r)
+    w_history = np.empty((n_steps,) + allocator.weight.shape)
+    for step in range(n_steps):
+        w_history[step] = allocator.weight
+        zc_price = zc_prices[step+1] if zc_prices is not None and step+1 < n_steps else None
+        allocator.step(psp_r[step], ghp_r[step], zc_price)
+    return w_history
+
+
 def drawdown_allocator(psp_r, ghp_r, maxdd, m=3):
     """
     Allocate between PSP and GHP with the goal to provide exposure to the upside
@@ -305,28 +1084,24 @@ def drawdown_allocator(psp_r, ghp_r, maxdd, m=3):
     of the cushion in the PSP
     Returns a DataFrame with the same shape as the psp/ghp representing the weights in the PSP
     """
-    n_steps, n_scenarios = psp_r.shape
-    account_value = np.repeat(1, n_scenarios)
-    floor_value = np.repeat(1, n_scenarios)
-    ### For MaxDD
-    peak_value = np.repeat(1, n_scenarios)
-    w_history = pd.DataFrame(index=psp_r.index, columns=psp_r.columns)
-    for step in range(n_steps):
-        ### For MaxDD
-        floor_value = (1-maxdd)*peak_value ### Floor is based on Prev Peak
-        cushion = (account_value - floor_value)/account_value
-        psp_w = (m*cushion).clip(0, 1) # same as applying min and max
-        ghp_w = 1-psp_w
-        psp_alloc = account_value*psp_w
-        ghp_alloc = account_value*ghp_w
-        # recompute the new account value at the end of this step
-        account_value = psp_alloc*(1+psp_r.iloc[step]) + ghp_alloc*(1+ghp_r.iloc[step])
-        ### For MaxDD
-        peak_value = np.maximum(peak_value, account_value) ### For MaxDD
-        w_history.iloc[step] = psp_w
-    return w_history
+    w_history = drawdown_allocator_arrays(psp_r, ghp_r, maxdd, m=m)
+    return pd.DataFrame(w_history, index=psp_r.index, columns=psp_r.columns)
 
 
+def drawdown_allocator_arrays(psp_r, ghp_r, maxdd, m=3):
+    """
+    Array version of drawdown_allocator: psp_r and ghp_r are T x N arrays (or DataFrames)
+    and the floor is (1-maxdd) times the previous peak of the account value
+    maxdd and m can be arrays that broadcast against the N scenarios, e.g. P x 1 to run P parameter points
+    in the same recursion (see bt_mix_sweep)
+    Returns a T x N (or T x P x N) float64 array of the weights in the PSP
+    """
+    psp_r = np.ascontiguousarray(psp_r, dtype=np.float64)
+    ghp_r = np.broadcast_to(np.ascontiguousarray(ghp_r, dtype=np.float64), psp_r.shape)
+    allocator = CPPIAllocator(m=m, maxdd=maxdd, n_scenarios=psp_r.shape[1])
+    return run_allocator(allocator, psp_r, ghp_r)
+
+drawdown_allocator.arrays = drawdown_allocator_arrays
 
 
 def discount(t, r):
@@ -348,9 +1123,21 @@ def fixedmix_allocator(r1, r2, w1, **kwargs):
         PSP and GHP are T x N DataFrames that represent the returns of the PSP and GHP such that:
          each column is a scenario
          each row is the price for a timestep
-        Returns an T x N DataFrame of PSP Weights
+        Returns a Series of PSP Weights indexed by the T steps, which bt_mix broadcasts over the N scenarios
+    """
+    return pd.Series(data=w1, index=r1.index, dtype=np.float64)
+
+
+def fixedmix_allocator_arrays(r1, r2, w1, **kwargs):
     """
-    return pd.DataFrame(data=w1, index=r1.index, columns=r1.columns)
+    Array version of fixedmix_allocator, w1 can be an array that broadcasts against the N scenarios
+    Returns a read-only T x N (or T x P x N) broadcast view of the PSP weights
+    """
+    n_steps, n_scenarios = np.shape(r1)
+    w1 = np.asarray(w1, dtype=np.float64)
+    return np.broadcast_to(w1, (n_steps,) + np.broadcast_shapes(w1.shape, (n_scenarios,)))
+
+fixedmix_allocator.arrays = fixedmix_allocator_arrays
 
 
 def floor_allocator(psp_r, ghp_r, floor, zc_prices, m=3):
@@ -361,23 +1148,88 @@ def floor_allocator(psp_r, ghp_r, floor, zc_prices, m=3):
     of the cushion in the PSP
     Returns a DataFrame with the same shape as the psp/ghp representing the weights in the PSP
     """
+    w_history = floor_allocator_arrays(psp_r, ghp_r, floor, zc_prices, m=m)
+    return pd.DataFrame(w_history, index=psp_r.index, columns=psp_r.columns)
+
+
+def floor_allocator_arrays(psp_r, ghp_r, floor, zc_prices, m=3):
+    """
+    Array version of floor_allocator: psp_r, ghp_r and zc_prices are T x N arrays (or DataFrames)
+    The inputs are copied once to C order so that every step works on contiguous rows
+    floor and m can be arrays that broadcast against the N scenarios, e.g. P x 1 to run P parameter points
+    in the same recursion (see bt_mix_sweep)
+    Returns a T x N (or T x P x N) float64 array of the weights in the PSP
+    """
+    psp_r = np.ascontiguousarray(psp_r, dtype=np.float64)
+    zc_prices = np.ascontiguousarray(zc_prices, dtype=np.float64)
     if zc_prices.shape != psp_r.shape:
         raise ValueError("PSP and ZC Prices must have the same shape")
-    n_steps, n_scenarios = psp_r.shape
-    account_value = np.repeat(1, n_scenarios)
-    floor_value = np.repeat(1, n_scenarios)
-    w_history = pd.DataFrame(index=psp_r.index, columns=psp_r.columns)
-    for step in range(n_steps):
-        floor_value = floor*zc_prices.iloc[step] ## PV of Floor assuming today's rates and flat YC
-        cushion = (account_value - floor_value)/account_value
-        psp_w = (m*cushion).clip(0, 1) # same as applying min and max
-        ghp_w = 1-psp_w
-        psp_alloc = account_value*psp_w
-        ghp_alloc = account_value*ghp_w
-        # recompute the new account value at the end of this step
-        account_value = psp_alloc*(1+psp_r.iloc[step]) + ghp_alloc*(1+ghp_r.iloc[step])
-        w_history.iloc[step] = psp_w
-    return w_history
+    ghp_r = np.broadcast_to(np.ascontiguousarray(ghp_r, dtype=np.float64), psp_r.shape)
+    allocator = CPPIAllocator(m=m, floor=floor, zc_price=zc_prices[0] if len(zc_prices) else 1.0,
+                              n_scenarios=psp_r.shape[1])
+    return run_allocator(allocator, psp_r, ghp_r, zc_prices)
+
+floor_allocator.arrays = floor_allocator_arrays
+
+
+def frontier_corners(er, cov, tol=1e-12):
+    """
+    Returns the corner portfolios of the long only efficient frontier as an n_corners x N array,
+    from the maximum return portfolio down to the GMV portfolio
+    Uses the Critical Line Algorithm: the frontier portfolios minimize 0.5*w'.cov.w - t*er'.w for t going from
+    infinity to 0, and between two corners (where an asset enters or leaves the portfolio) the weights
+    are linear in t, so every frontier portfolio is a linear combination of two consecutive corners
+    """
+    mu = np.asarray(er, dtype=float)
+    cov = np.asarray(cov, dtype=float)
+    n = mu.shape[0]
+    # start with the highest return assets, if there are ties take their minimum variance mix
+    free = mu >= mu.max() - tol*max(1, np.abs(mu).max())
+    w = np.zeros(n)
+    w[free] = min_var_long_only(cov[np.ix_(free, free)], np.ones(free.sum()))
+    free = w > 0
+    corners = [w]
+    t_cur = np.inf
+    last = None
+    while True:
+        factor = cho_factor(cov[np.ix_(free, free)])
+        a_1 = cho_solve(factor, np.ones(free.sum()))
+        a_mu = cho_solve(factor, mu[free])
+        s_1, s_mu = a_1.sum(), a_mu.sum()
+        # on the current critical line w_F(t) = alpha + t*beta and the multiplier of the budget is gamma(t)
+        alpha = a_1/s_1
+        beta = a_mu - a_1*s_mu/s_1
+        free_idx, bound_idx = np.flatnonzero(free), np.flatnonzero(~free)
+        # free assets whose weight falls to zero as t decreases
+        with np.errstate(divide="ignore", invalid="ignore"):
+            t_out = np.where(beta > tol, -alpha/beta, -np.inf)
+        # bound assets whose multiplier eta_j(t) = c_0 + t*c_1 falls to zero as t decreases
+        c_0 = cov[np.ix_(bound_idx, free_idx)] @ alpha - 1/s_1
+        c_1 = cov[np.ix_(bound_idx, free_idx)] @ beta - mu[bound_idx] + s_mu/s_1
+        with np.errstate(divide="ignore", invalid="ignore"):
+            t_in = np.where(c_1 > tol, -c_0/c_1, -np.inf)
+        t_out[free_idx == last] = -np.inf
+        t_in[bound_idx == last] = -np.inf
+        t_out[t_out >= t_cur] = -np.inf
+        t_in[t_in >= t_cur] = -np.inf
+        t_next = max(t_out.max(initial=-np.inf), t_in.max(initial=-np.inf))
+        if t_next <= 0:
+            # no more corners before t = 0, the last one is the GMV portfolio
+            w = np.zeros(n)
+            w[free] = alpha
+            corners.append(w)
+            break
+        w = np.zeros(n)
+        w[free] = np.clip(alpha + t_next*beta, 0, None)
+        corners.append(w)
+        if t_out.max(initial=-np.inf) >= t_in.max(initial=-np.inf):
+            last = free_idx[np.argmax(t_out)]
+            free[last] = False
+        else:
+            last = bound_idx[np.argmax(t_in)]
+            free[last] = True
+        t_cur = t_next
+    return np.array(corners)
 
 
 def funding_ratio(assets, liabilities, r):
@@ -387,7 +1239,292 @@ def funding_ratio(assets, liabilities, r):
     return pv(assets, r)/pv(liabilities, r)
 
 
-def gbm(n_years=10, n_scenarios=1000, mu=0.07, sigma=0.15, steps_per_year=12, s_0=100.0, prices=True):
+# number of scenarios drawn from each random stream spawned by generate_scenarios
+SCENARIO_BLOCK = 1024
+
+
+def as_generator(rng=None):
+    """
+    Returns the source of random numbers of the scenario generators (gbm, cir, ...): the global numpy random state
+    if rng is None, so that np.random.seed keeps working, otherwise a numpy Generator built from rng
+    (a seed, a SeedSequence or a Generator, which is used as is)
+    """
+    return np.random if rng is None else np.random.default_rng(rng)
+
+
+def _scenario_block(generator, seed, n_scenarios, kwargs):
+    """
+    Runs a scenario generator for one block of scenarios, on the random stream seeded by seed
+    """
+    return generator(n_scenarios=n_scenarios, rng=np.random.default_rng(seed), **kwargs)
+
+
+def _concat_scenarios(blocks):
+    """
+    Concatenates the outputs of a scenario generator (arrays, DataFrames or tuples or dicts of them) along the scenarios
+    """
+    if isinstance(blocks[0], tuple):
+        return tuple(_concat_scenarios(list(parts)) for parts in zip(*blocks))
+    if isinstance(blocks[0], dict):
+        return {key: _concat_scenarios([block[key] for block in blocks]) for key in blocks[0]}
+    if isinstance(blocks[0], pd.DataFrame):
+        scenarios = pd.concat(blocks, axis=1)
+        scenarios.columns = range(scenarios.shape[1])
+        return scenarios
+    return np.concatenate(blocks, axis=1)
+
+
+def generate_scenarios(generator, n_scenarios, seed=None, block_size=SCENARIO_BLOCK, n_jobs=1, executor=None,
+                       **kwargs):
+    """
+    Runs a scenario generator such as gbm or cir (any function taking n_scenarios and rng) in blocks of block_size
+    scenarios, each block drawing from its own stream spawned from seed with SeedSequence.spawn.
+    The blocks are run in parallel over n_jobs processes (all the cores if -1) or on the supplied executor,
+    the streams only depend on the seed and the block size, so the same seed gives bit-identical scenarios
+    whatever the number of workers
+    kwargs are passed to the generator, its outputs are concatenated along the scenarios
+    """
+    seed_seq = seed if isinstance(seed, np.random.SeedSequence) else np.random.SeedSequence(seed)
+    sizes = [min(block_size, n_scenarios - start) for start in range(0, n_scenarios, block_size)] or [0]
+    args = [(generator, block_seed, size, kwargs) for block_seed, size in zip(seed_seq.spawn(len(sizes)), sizes)]
+    if n_jobs == 1 and executor is None:
+        blocks = [_scenario_block(*block_args) for block_args in args]
+    else:
+        n_jobs = os.cpu_count() if n_jobs is None or n_jobs < 1 else n_jobs
+        pool = ProcessPoolExecutor(max_workers=n_jobs) if executor is None else executor
+        try:
+            blocks = list(pool.map(_scenario_block, *zip(*args)))
+        finally:
+            if executor is None:
+                pool.shutdown()
+    return _concat_scenarios(blocks)
+
+
+def normal_shocks(random, size, antithetic=False, moment_matching=False, sampler="pseudo"):
+    """
+    Draws an array of standard normal shocks of shape size, T x N or T x N x K for K factors,
+    from random (see as_generator) with optional variance reduction
+    antithetic: scenarios 2i and 2i+1 get opposite shocks, N must be even (see mc_mean for their standard errors)
+    moment_matching: the shocks of each step are rescaled to an exact zero mean and unit variance across scenarios,
+    the scenarios are then no longer independent and the standard errors of mc_mean are conservative
+    sampler: "pseudo" draws pseudo-random numbers, "sobol" or "halton" use a scrambled low discrepancy sequence
+    (see quasi_normal_shocks)
+    The first row (time 0) is not used by the scenario generators, the low discrepancy samplers leave it at 0
+    """
+    n_steps, n_scenarios = size[:2]
+    if antithetic and n_scenarios % 2:
+        raise ValueError("antithetic shocks need an even number of scenarios")
+    draw_size = (n_steps, n_scenarios//2 if antithetic else n_scenarios) + tuple(size[2:])
+    if sampler == "pseudo":
+        draws = random.standard_normal(draw_size)
+    elif sampler in ("sobol", "halton"):
+        draws = quasi_normal_shocks(random, draw_size, sampler)
+    else:
+        raise ValueError(f"Unknown sampler {sampler}, expected 'pseudo', 'sobol' or 'halton'")
+    if antithetic:
+        shock = np.empty(size)
+        shock[:, 0::2] = draws
+        np.negative(shock[:, 0::2], out=shock[:, 1::2])
+    else:
+        shock = draws
+    if moment_matching:
+        shock -= shock.mean(axis=1, keepdims=True)
+        std = shock.std(axis=1, keepdims=True)
+        shock /= np.where(std > 0, std, 1)
+    return shock
+
+
+def quasi_normal_shocks(random, size, sampler="sobol"):
+    """
+    Standard normal shocks of shape size (T x N or T x N x K) from a scrambled Sobol or Halton sequence:
+    each scenario is one point in (T-1)*K dimensions, mapped to normals with the inverse normal cdf
+    Only the rows 1.. are drawn (row 0 is 0, the generators do not use it), and each path of shocks is built with a
+    Brownian bridge (see brownian_bridge_increments) so that the first, best distributed, coordinates of the sequence
+    drive the terminal values of the K factors, the next ones their middle points...
+    The scrambling is seeded from random, N should be a power of 2 for the Sobol sequence to be balanced
+    Scenarios that are combined path by path (e.g. equities and rates) must come from one call, see
+    correlated_scenarios: two separately scrambled sequences paired by scenario are not jointly low discrepancy,
+    and the error of the joint statistics then no longer decreases with N
+    """
+    n_steps, n_scenarios = size[:2]
+    shock = np.zeros(size)
+    n_dims = int(np.prod(size)) // max(n_scenarios, 1) - int(np.prod(size[2:]))
+    if n_dims == 0 or n_scenarios == 0:
+        return shock
+    seed = random if isinstance(random, np.random.Generator) else random.randint(0, 2**31 - 1)
+    engine = qmc.Sobol(d=n_dims, scramble=True, seed=seed) if sampler == "sobol" else \
+        qmc.Halton(d=n_dims, scramble=True, seed=seed)
+    points = engine.random(n_scenarios)
+    eps = np.finfo(np.float64).eps
+    z = norm.ppf(np.clip(points, eps, 1 - eps))
+    # dimensions are ordered by bridge point first and factor second
+    z = np.moveaxis(z.reshape((n_scenarios, n_steps-1) + tuple(size[2:])), 0, 1)
+    shock[1:] = brownian_bridge_increments(z)
+    return shock
+
+
+def brownian_bridge_increments(z):
+    """
+    Turns the m x ... independent standard normals z into the m increments of Brownian paths with unit variance per
+    step, built with a Brownian bridge: z[0] sets the end point of the paths, z[1] their middle point, z[2] and z[3]
+    the quarter points and so on. The increments are again independent standard normals, but the first rows of z
+    now drive the overall shape of the paths, which is where quasi Monte Carlo puts its best distributed coordinates
+    """
+    m = z.shape[0]
+    path = np.zeros((m+1,) + z.shape[1:])
+    path[m] = np.sqrt(m)*z[0]
+    intervals, k = [(0, m)], 1
+    for left, right in intervals:
+        # breadth first: intervals appended while iterating are visited after the current level
+        if right - left < 2:
+            continue
+        mid = (left + right)//2
+        path[mid] = ((right-mid)*path[left] + (mid-left)*path[right])/(right-left) + \
+            np.sqrt((mid-left)*(right-mid)/(right-left))*z[k]
+        k += 1
+        intervals += [(left, mid), (mid, right)]
+    return np.diff(path, axis=0)
+
+
+def _json_default(x):
+    """
+    Converts the numpy values found in scenario parameters to JSON
+    """
+    if isinstance(x, (np.ndarray, np.generic)):
+        return x.tolist()
+    return str(x)
+
+
+def _index_to_json(index):
+    """
+    Describes a pandas Index (the labels of a saved scenario DataFrame) in JSON, see _index_from_json
+    """
+    if isinstance(index, pd.RangeIndex):
+        return {"range": [index.start, index.stop, index.step], "name": index.name}
+    if isinstance(index, pd.MultiIndex):
+        return {"levels": [_index_to_json(index.get_level_values(i)) for i in range(index.nlevels)]}
+    # dates and periods are written as strings and parsed back with their dtype
+    values = index.tolist() if index.dtype.kind in "biuf" or index.dtype == object else index.astype(str).tolist()
+    spec = {"values": values, "dtype": str(index.dtype), "name": index.name}
+    if isinstance(index, (pd.DatetimeIndex, pd.TimedeltaIndex)) and index.freq is not None:
+        spec["freq"] = index.freqstr
+    return spec
+
+
+def _index_from_json(spec):
+    """
+    Rebuilds the pandas Index described by _index_to_json
+    """
+    if "range" in spec:
+        return pd.RangeIndex(*spec["range"], name=spec["name"])
+    if "levels" in spec:
+        return pd.MultiIndex.from_arrays([_index_from_json(level) for level in spec["levels"]])
+    index = pd.Index(spec["values"], dtype=spec["dtype"], name=spec["name"])
+    if spec.get("freq") is not None:
+        index = type(index)(index, freq=spec["freq"])
+    return index
+
+
+class ScenarioStore:
+    """
+    Directory of scenario sets, each saved as .npy files plus a metadata.json header (generator, parameters, seed)
+    The sets are read back as read-only memory maps, so bt_mix, the allocators and terminal_stats run on them
+    without loading them (the pages are read lazily), and get_or_generate only runs a generator the first time
+    a given set of parameters is requested
+    """
+
+    def __init__(self, root):
+        self.root = root
+        os.makedirs(root, exist_ok=True)
+
+    def _path(self, name, file):
+        return os.path.join(self.root, name, file)
+
+    def metadata(self, name):
+        """ Returns the metadata of the scenario set name, or None if it does not exist or was not fully written """
+        try:
+            with open(self._path(name, "metadata.json")) as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return None
+
+    def save(self, name, scenarios, **metadata):
+        """
+        Writes the output of a scenario generator (an array, a DataFrame, or a tuple or dict of them)
+        as the scenario set name, with the metadata. The header is written last so a partial write is never loaded
+        The index and column labels of the DataFrames are kept in the header, and the files of a previous version
+        of the set that are not part of the new one are removed
+        Returns the scenario set read back as memory maps (see load)
+        """
+        if isinstance(scenarios, dict):
+            structure, parts = "dict", scenarios
+        elif isinstance(scenarios, tuple):
+            structure, parts = "tuple", {str(i): part for i, part in enumerate(scenarios)}
+        else:
+            structure, parts = "single", {"paths": scenarios}
+        os.makedirs(os.path.join(self.root, name), exist_ok=True)
+        if os.path.exists(self._path(name, "metadata.json")):
+            os.remove(self._path(name, "metadata.json"))
+        for i, values in enumerate(parts.values()):
+            # write then rename, so that memory maps still open on a previous version keep their own file
+            with open(self._path(name, f"{i}.npy.tmp"), "wb") as f:
+                np.save(f, np.ascontiguousarray(values, dtype=np.float64))
+            os.replace(self._path(name, f"{i}.npy.tmp"), self._path(name, f"{i}.npy"))
+        labels = [{"index": _index_to_json(values.index), "columns": _index_to_json(values.columns)}
+                  if isinstance(values, pd.DataFrame) else None for values in parts.values()]
+        metadata = dict(metadata, structure=structure, keys=list(parts),
+                        frames=[isinstance(values, pd.DataFrame) for values in parts.values()], labels=labels)
+        with open(self._path(name, "metadata.json"), "w") as f:
+            json.dump(metadata, f, default=_json_default, indent=1)
+        for file in os.listdir(os.path.join(self.root, name)):
+            stem = file[:-len(".npy")]
+            if file.endswith(".npy") and stem.isdigit() and int(stem) >= len(parts):
+                os.remove(self._path(name, file))
+        return self.load(name)
+
+    def load(self, name, mmap_mode="r"):
+        """
+        Reads the scenario set name back in the structure it was saved in, as memory mapped arrays
+        (or DataFrames wrapping them without a copy)
+        """
+        metadata = self.metadata(name)
+        if metadata is None:
+            raise KeyError(f"No scenario set {name} in {self.root}")
+        parts = []
+        labels = metadata.get("labels") or [None]*len(metadata["frames"])
+        for i, (is_frame, label) in enumerate(zip(metadata["frames"], labels)):
+            values = np.load(self._path(name, f"{i}.npy"), mmap_mode=mmap_mode)
+            if is_frame and label is not None:
+                values = pd.DataFrame(values, index=_index_from_json(label["index"]),
+                                      columns=_index_from_json(label["columns"]), copy=False)
+            elif is_frame:
+                values = pd.DataFrame(values, copy=False)
+            parts.append(values)
+        if metadata["structure"] == "dict":
+            return dict(zip(metadata["keys"], parts))
+        if metadata["structure"] == "tuple":
+            return tuple(parts)
+        return parts[0]
+
+    def get_or_generate(self, name, generator, n_scenarios, seed=None, block_size=SCENARIO_BLOCK, n_jobs=1,
+                        **params):
+        """
+        Loads the scenario set name if it was generated by the same generator with the same n_scenarios, seed,
+        block_size and params, otherwise generates it with generate_scenarios (which makes it reproducible
+        from the seed) and saves it first
+        """
+        request = json.loads(json.dumps({"generator": generator.__name__, "n_scenarios": n_scenarios, "seed": seed,
+                                         "block_size": block_size, "params": params}, default=_json_default))
+        metadata = self.metadata(name)
+        if metadata is not None and all(metadata.get(key) == value for key, value in request.items()):
+            return self.load(name)
+        scenarios = generate_scenarios(generator, n_scenarios, seed=seed, block_size=block_size, n_jobs=n_jobs,
+                                       **params)
+        return self.save(name, scenarios, **request)
+
+
+def gbm(n_years=10, n_scenarios=1000, mu=0.07, sigma=0.15, steps_per_year=12, s_0=100.0, prices=True, rng=None,
+        antithetic=False, moment_matching=False, sampler="pseudo", method="normal", times=None):
     """
     Evolution of Geometric Brownian Motion trajectories, such as for Stock Prices through Monte Carlo
     :param n_years:  The number of years to generate data for
@@ -397,20 +1534,96 @@ def gbm(n_years=10, n_scenarios=1000, mu=0.07, sigma=0.15, steps_per_year=12, s_
     :param steps_per_year: granularity of the simulation
     :param s_0: initial value
     :param prices: Prices
+    :param rng: seed or numpy Generator (see as_generator), use generate_scenarios to split the scenarios over workers
+    :param antithetic: pair each scenario with its mirror image (see normal_shocks)
+    :param moment_matching: rescale the shocks of each step to an exact zero mean and unit variance
+    :param sampler: "pseudo", or "sobol"/"halton" for quasi Monte Carlo shocks (see normal_shocks)
+    :param method: "normal" draws normal gross returns with mean (1+mu)**dt, "exact" samples the exact log-normal
+    transition, so that any step size (e.g. annual) has the right distribution. Both have E[S_t] = s_0*(1+mu)**t
+    :param times: optional increasing times in years starting at 0, possibly uneven, replacing the grid of
+    n_years*steps_per_year steps; the prices are then indexed by the times
     :return: a numpy array of n_paths columns and n_years*steps_per_year rows
     """
+    random = as_generator(rng)
     # Derive per-step Model Parameters from User Specifications
-    dt = 1/steps_per_year
-    n_steps = int(n_years*steps_per_year) + 1
-    # the standard way ...
-    # rets_plus_1 = np.random.normal(loc=mu*dt+1, scale=sigma*np.sqrt(dt), size=(n_steps, n_scenarios))
-    # without discretization error ...
-    rets_plus_1 = np.random.normal(loc=(1+mu)**dt, scale=(sigma*np.sqrt(dt)), size=(n_steps, n_scenarios))
+    if times is None:
+        dt = 1/steps_per_year
+        n_steps = int(n_years*steps_per_year) + 1
+    else:
+        times = np.asarray(times, dtype=np.float64)
+        dt = np.diff(times, prepend=times[0])[:, None]
+        n_steps = len(times)
+    shock = normal_shocks(random, (n_steps, n_scenarios), antithetic, moment_matching, sampler)
+    if method == "normal":
+        # the standard way ...
+        # rets_plus_1 = np.random.normal(loc=mu*dt+1, scale=sigma*np.sqrt(dt), size=(n_steps, n_scenarios))
+        # without discretization error ...
+        rets_plus_1 = (1+mu)**dt + (sigma*np.sqrt(dt))*shock
+    elif method == "exact":
+        rets_plus_1 = np.exp((np.log1p(mu) - sigma**2/2)*dt + (sigma*np.sqrt(dt))*shock)
+    else:
+        raise ValueError(f"Unknown method {method}, expected 'normal' or 'exact'")
     rets_plus_1[0] = 1
-    ret_val = s_0*pd.DataFrame(rets_plus_1).cumprod() if prices else rets_plus_1-1
+    ret_val = s_0*pd.DataFrame(rets_plus_1, index=times).cumprod() if prices else rets_plus_1-1
     return ret_val
 
 
+def _gbm_grid(prices, times, steps_per_year):
+    """
+    Log prices and step sizes of GBM paths given as a T x N DataFrame or array
+    """
+    log_prices = np.log(np.asarray(prices, dtype=np.float64))
+    times = np.arange(len(log_prices))/steps_per_year if times is None else np.asarray(times, dtype=np.float64)
+    return log_prices, np.diff(times)[:, None]
+
+
+def gbm_bridge_extremes(prices, sigma, times=None, steps_per_year=12, rng=None):
+    """
+    Samples the minimum and the maximum of each GBM path between consecutive points of its grid,
+    conditionally on the end points: the log prices between two points are a Brownian bridge whose minimum
+    (maximum) is drawn exactly by inverting P(min < m) = exp(-2(x0-m)(x1-m)/(sigma^2 dt))
+    The minimum and maximum of a step are drawn independently of each other
+    prices are T x N as returned by gbm, times are their times in years (n/steps_per_year if None)
+    Returns two (T-1) x N arrays, the minima and the maxima
+    """
+    random = as_generator(rng)
+    log_prices, dt = _gbm_grid(prices, times, steps_per_year)
+    x_0, x_1 = log_prices[:-1], log_prices[1:]
+    spread_sq = (x_1 - x_0)**2 - 2*sigma**2*dt*np.log(random.random((2,) + x_0.shape))
+    spread = np.sqrt(spread_sq)
+    return np.exp((x_0 + x_1 - spread[0])/2), np.exp((x_0 + x_1 + spread[1])/2)
+
+
+def gbm_breach_probability(prices, barrier, sigma, times=None, steps_per_year=12):
+    """
+    Probability, for each GBM path, that the continuous path went below barrier at any time and not only
+    at the points of its grid, given the points (analytic running minimum correction, nothing is sampled)
+    barrier is a scalar, or an array that broadcasts against the T x N prices, taken constant over each step
+    Returns an array of N probabilities, whose mean estimates the breach probability of the continuous path
+    """
+    log_prices, dt = _gbm_grid(prices, times, steps_per_year)
+    log_barrier = np.broadcast_to(np.log(barrier), log_prices.shape)[:-1]
+    d_0 = log_prices[:-1] - log_barrier
+    d_1 = log_prices[1:] - log_barrier
+    with np.errstate(over="ignore"):
+        p_cross = np.where((d_0 > 0) & (d_1 > 0), np.exp(-2*d_0*d_1/(sigma**2*dt)), 1.)
+    return 1 - np.prod(1 - p_cross, axis=0)
+
+
+def gbm_max_drawdown(prices, sigma, times=None, steps_per_year=12, rng=None):
+    """
+    Maximum drawdown of each GBM path, corrected for what happens between the points of its grid:
+    the peaks include the sampled maxima of the earlier steps and the troughs are the sampled minima of each step
+    (see gbm_bridge_extremes), a coarse (e.g. monthly) grid then gives close to the drawdowns of a fine one
+    Returns an array of N maximum drawdowns, as negative numbers like drawdown()
+    """
+    lows, highs = gbm_bridge_extremes(prices, sigma, times=times, steps_per_year=steps_per_year, rng=rng)
+    values = np.asarray(prices, dtype=np.float64)
+    peaks = np.maximum.accumulate(values[:-1], axis=0)
+    peaks[1:] = np.maximum(peaks[1:], np.maximum.accumulate(highs[:-1], axis=0))
+    return ((lows - peaks)/peaks).min(axis=0)
+
+
 def get_ind_file(filetype, weighting="vw", n_inds=30):
     """
     Load and format the Ken French Industry Portfolios files
@@ -500,24 +1713,22 @@ def glidepath_allocator(r1, r2, start_glide=1, end_glide=0.0):
     """
     Allocates weights to r1 starting at start_glide and ends at end_glide
     by gradually moving from start_glide to end_glide over time
+    Returns a Series of PSP Weights indexed by the T steps, which bt_mix broadcasts over the N scenarios
     """
     n_points = r1.shape[0]
-    n_col = r1.shape[1]
-    path = pd.Series(data=np.linspace(start_glide, end_glide, num=n_points))
-    paths = pd.concat([path]*n_col, axis=1)
-    paths.index = r1.index
-    paths.columns = r1.columns
-    return paths
+    return pd.Series(data=np.linspace(start_glide, end_glide, num=n_points), index=r1.index)
 
 
-def gmv(cov):
+def gmv(cov, long_only=True, ctx=None):
     """
     Returns the weights of the Global Minimum Volatility portfolio
     given a covariance matrix
+    If long_only is False, short positions are allowed and the closed form solution is returned
+    ctx is an optional OptimizerContext to warm start from the previous call
     """
-    # If you assume all returns are the same the optimizer minimizes variance and you get GMV
+    # If you assume all returns are the same the minimum variance portfolio is the max sharpe ratio portfolio
     n = cov.shape[0]
-    return msr(0, np.repeat(1, n), cov)
+    return msr(0, np.repeat(1, n), cov, long_only=long_only, ctx=ctx)
 
 
 def implied_returns(delta, sigma, w):
@@ -597,13 +1808,135 @@ def match_durations(cf_t, cf_s, cf_l, discount_rate):
     return (d_l - d_t)/(d_l - d_s)
 
 
-def minimize_vol(target_return, est_returns, cov):
+class OptimizerContext:
+    """
+    State carried by the optimizers across consecutive calls, e.g. across the windows of a rolling backtest.
+    Each optimizer starts from its previous solution (and the active-set solver from its previous set of
+    non zero assets) instead of the equally weighted portfolio, and records how many iterations it took.
+    Pass the same instance as ctx= to every call, e.g. backtest_ws(r, weighting=weight_gmv, ctx=OptimizerContext())
+    """
+
+    def __init__(self):
+        self.state = {}
+        self.iterations = {}
+
+    def get(self, name, n):
+        """ Returns the state saved by the optimizer "name" for a problem with n assets, or None """
+        state = self.state.get(name)
+        if state is None or state["n"] != n:
+            return None
+        return state
+
+    def save(self, name, n, n_iter, **state):
+        """ Saves the state of the optimizer "name" after a call that took n_iter iterations """
+        self.state[name] = dict(state, n=n)
+        self.iterations.setdefault(name, []).append(n_iter)
+
+    def stats(self):
+        """ Returns a DataFrame with the number of calls and iterations of each optimizer """
+        return pd.DataFrame({
+            "calls": {name: len(its) for name, its in self.iterations.items()},
+            "iterations": {name: sum(its) for name, its in self.iterations.items()},
+            "mean iterations": {name: np.mean(its) for name, its in self.iterations.items()},
+        })
+
+
+def _min_var_free_set(cov, a):
+    """
+    Returns the weights x that minimize x'.cov.x subject to a'.x = 1 (no sign constraint), and the multiplier lam
+    of the constraint (cov.x = lam*a)
+    Uses a Cholesky factorization when cov is positive definite, and the least squares solution of the KKT system
+    when cov is singular, e.g. when an asset is a combination of the others over the estimation window
+    """
+    n = a.shape[0]
+    try:
+        factor = cho_factor(cov)
+        # a pivot at the rounding error level means that cov is singular and the solve would be garbage
+        if np.diag(factor[0]).min()**2 > n*np.finfo(float).eps*np.diag(cov).max():
+            y = cho_solve(factor, a)
+            lam = 1/(a @ y)
+            return lam*y, lam
+    except np.linalg.LinAlgError:
+        pass
+    kkt = np.block([[cov, a[:, None]], [a[None, :], np.zeros((1, 1))]])
+    solution = np.linalg.lstsq(kkt, np.r_[np.zeros(n), 1.], rcond=None)[0]
+    return solution[:n], -solution[n]
+
+
+def min_var_long_only(cov, a, tol=1e-12, ctx=None):
+    """
+    Returns the weights x that minimize the variance x'.cov.x subject to a'.x = 1 and x >= 0
+    With a = 1 this is the long only GMV portfolio, with a = excess returns it is the (unscaled) MSR portfolio
+    Uses a primal active-set method: the problem restricted to the assets that are not at zero (the free set)
+    is solved exactly (see _min_var_free_set), and assets enter or leave the free set until the KKT
+    conditions hold. Singular covariance matrices (e.g. estimated over fewer periods than assets) are supported,
+    the free set blocks that are singular being solved by least squares
+    If an OptimizerContext is supplied, it starts from the free set of the previous call when that is feasible
+    """
+    cov = np.asarray(cov, dtype=float)
+    a = np.asarray(a, dtype=float)
+    n = a.shape[0]
+    if not (a > 0).any():
+        raise ValueError("At least one element of a must be positive")
+    diag_max = np.diag(cov).max()
+    x = None
+    state = ctx.get("min_var_long_only", n) if ctx is not None else None
+    if state is not None and (a[state["free"]] > 0).any():
+        free = state["free"].copy()
+        try:
+            y = cho_solve(cho_factor(cov[np.ix_(free, free)]), a[free])
+        except np.linalg.LinAlgError:
+            # the previous free set is singular on the new covariance, start cold
+            y = None
+        if y is not None and (y >= 0).all() and a[free] @ y > 0:
+            x = np.zeros(n)
+            x[free] = y/(a[free] @ y)
+    if x is None:
+        # start at the single asset portfolio with the lowest variance
+        diag = np.diag(cov)
+        k = np.argmin(np.where(a > 0, diag/np.where(a > 0, a, 1)**2, np.inf))
+        x = np.zeros(n)
+        x[k] = 1/a[k]
+        free = np.zeros(n, dtype=bool)
+        free[k] = True
+    for n_iter in range(1, 10*n + 11):
+        # solve the equality constrained problem on the free set: cov_FF.x_F = lam*a_F, a_F'.x_F = 1
+        x_free, lam = _min_var_free_set(cov[np.ix_(free, free)], a[free])
+        if (x_free >= 0).all():
+            x = np.zeros(n)
+            x[free] = x_free
+            # the multipliers of the assets held at zero must be non negative
+            # (lam is the variance of x, the absolute floor covers the portfolios without variance)
+            mu = cov[~free] @ x - lam*a[~free]
+            if mu.size == 0 or mu.min() >= -tol*max(abs(lam)*max(1, np.abs(a).max()), diag_max):
+                if ctx is not None:
+                    ctx.save("min_var_long_only", n, n_iter, free=free)
+                return x
+            free[np.flatnonzero(~free)[np.argmin(mu)]] = True
+        else:
+            # move towards x_free until the first free asset hits zero, and take it out of the free set
+            x_old = x[free]
+            shrinking = x_free < 0
+            steps = x_old[shrinking]/(x_old[shrinking]-x_free[shrinking])
+            x_step = x_old + steps.min()*(x_free-x_old)
+            blocking = shrinking & (x_step <= tol*np.abs(x_old).max())
+            blocking[np.flatnonzero(shrinking)[np.argmin(steps)]] = True
+            x = np.zeros(n)
+            x[free] = np.where(blocking, 0, x_step)
+            free_idx = np.flatnonzero(free)
+            free[free_idx[blocking]] = False
+    raise RuntimeError("min_var_long_only did not converge")
+
+
+def minimize_vol(target_return, est_returns, cov, ctx=None):
     """
     Returns the optimal weights that achieve the target return
     given a set of expected returns and a covariance matrix
+    ctx is an optional OptimizerContext to warm start from the previous call
     """
     n = est_returns.shape[0]
-    init_guess = np.repeat(1/n, n)
+    state = ctx.get("minimize_vol", n) if ctx is not None else None
+    init_guess = np.repeat(1/n, n) if state is None else state["x"]
     bounds = ((0, 1),) * n
 
     # Construct constraints
@@ -618,17 +1951,32 @@ def minimize_vol(target_return, est_returns, cov):
                        options={'disp': False},
                        constraints=(wts_sum_to_1, tgt_return),
                        bounds=bounds)
+    if ctx is not None:
+        ctx.save("minimize_vol", n, weights.nit, x=weights.x)
     return weights.x
 
 
-def msr(rf_rate, er, cov):
+def msr(rf_rate, er, cov, long_only=True, ctx=None):
     """
         Returns the weights of the portfolio that gives you the maximum sharpe ratio
         given the riskfree rate and expected returns and a covariance matrix
         :param er: Expected returns (annualized)
-    """
+        :param long_only: If False, short positions are allowed and the closed form tangency portfolio is returned
+        :param ctx: Optional OptimizerContext to warm start from the previous call
+    """
+    excess = np.asarray(er, dtype=float) - rf_rate
+    if not long_only:
+        w = cho_solve(cho_factor(np.asarray(cov, dtype=float)), excess)
+        return w/w.sum()
+    if (excess > 0).any():
+        # max sharpe is the min variance portfolio with one unit of excess return, rescaled to sum to 1
+        w = min_var_long_only(cov, excess, ctx=ctx)
+        return w/w.sum()
+
+    # no asset beats the riskfree rate, leave it to the numerical optimizer
     n = er.shape[0]
-    init_guess = np.repeat(1/n, n)
+    state = ctx.get("msr", n) if ctx is not None else None
+    init_guess = np.repeat(1/n, n) if state is None else state["x"]
     bounds = ((0, 1),) * n
 
     def neg_sharpe(weights, rf_rate, er, cov):
@@ -645,16 +1993,33 @@ def msr(rf_rate, er, cov):
                        options={'disp': False},
                        constraints=(wts_sum_to_1,),
                        bounds=bounds)
+    if ctx is not None:
+        ctx.save("msr", n, weights.nit, x=weights.x)
     return weights.x
 
 
 def optimal_weights(n_points, er, cov):
     """
     Generates efficient frontier weights
+    The minimum volatility portfolios for n_points target returns between er.min() and er.max() are
+    interpolated between the corner portfolios of the frontier (see frontier_corners), the ones below
+    the return of the GMV portfolio being the corners obtained by minimizing the return instead
     """
     target_rs = np.linspace(er.min(), er.max(), n_points)
-    weights = [minimize_vol(target_return, er, cov) for target_return in target_rs]
-    return weights
+    upper = frontier_corners(er, cov)
+    lower = frontier_corners(-np.asarray(er, dtype=float), cov)
+    # corners sorted by increasing return: min return asset, ..., GMV, ..., max return asset
+    corners = np.concatenate([lower, upper[::-1][1:]])
+    corner_rs = corners @ np.asarray(er, dtype=float)
+    corner_rs = np.maximum.accumulate(corner_rs)
+    hi = np.clip(np.searchsorted(corner_rs, target_rs), 1, len(corners)-1)
+    lo = hi - 1
+    span = corner_rs[hi] - corner_rs[lo]
+    with np.errstate(divide="ignore", invalid="ignore"):
+        frac = np.where(span > 0, (target_rs - corner_rs[lo])/span, 0)
+    frac = np.clip(frac, 0, 1)[:, None]
+    weights = corners[lo]*(1-frac) + corners[hi]*frac
+    return list(weights)
 
 
 def plot_ef(n_points, er, cov, show_ew=False, show_gmv=False):
@@ -753,6 +2118,64 @@ def risk_contribution(w,cov):
     return risk_contrib
 
 
+def risk_budgeting(cov, budgets=None, init_guess=None, tol=1e-10, max_iter=100, ctx=None):
+    """
+    Returns the weights of the long only portfolio whose contributions to risk are proportional to the budgets,
+    given the covariance matrix (equal budgets if budgets is None)
+    Solves min 0.5*x'.cov.x - sum(budgets*log(x)) with a damped Newton method, whose solution rescaled to sum to 1
+    is the risk budgeting portfolio. Assets with a zero budget get a zero weight
+    init_guess is an optional set of starting weights, e.g. the solution of a previous rebalance
+    If an OptimizerContext is supplied instead, it starts from the solution of its previous call
+    """
+    cov = np.asarray(cov, dtype=float)
+    n = cov.shape[0]
+    budgets = np.repeat(1/n, n) if budgets is None else np.asarray(budgets, dtype=float)
+    if (budgets < 0).any() or budgets.sum() <= 0:
+        raise ValueError("budgets must be non negative and not all zero")
+    active = budgets > 0
+    sigma = cov[np.ix_(active, active)]
+    b = budgets[active]/budgets.sum()
+    if init_guess is None and ctx is not None:
+        state = ctx.get("risk_budgeting", n)
+        init_guess = None if state is None else state["x"]
+    if init_guess is None:
+        x = 1/np.sqrt(np.diag(sigma))
+    else:
+        x = np.clip(np.asarray(init_guess, dtype=float)[active], 1e-6, None)
+    # best rescaling of the starting point along its direction
+    x *= np.sqrt(b.sum()/(x @ sigma @ x))
+
+    def objective(x):
+        return 0.5*x @ sigma @ x - b @ np.log(x)
+
+    f = objective(x)
+    for n_iter in range(max_iter):
+        sigma_x = sigma @ x
+        if np.abs(x*sigma_x - b).max() < tol:
+            break
+        grad = sigma_x - b/x
+        step = -cho_solve(cho_factor(sigma + np.diag(b/x**2)), grad)
+        # backtrack to stay in x > 0 and get a sufficient decrease, close to the solution
+        # the decrease is below the precision of f and the full Newton step is taken
+        decrement = -grad @ step
+        t = 1.0
+        while True:
+            x_new = x + t*step
+            if (x_new > 0).all():
+                f_new = objective(x_new)
+                if decrement < 1e-12 or f_new <= f - 1e-4*t*decrement or t < 1e-10:
+                    break
+            t /= 2
+        x, f = x_new, f_new
+    else:
+        raise RuntimeError("risk_budgeting did not converge")
+    w = np.zeros(n)
+    w[active] = x/x.sum()
+    if ctx is not None:
+        ctx.save("risk_budgeting", n, n_iter, x=w)
+    return w
+
+
 def regress(dependent_variable, explanatory_variables, alpha=True):
     """
     Runs a linear regression to decompose the dependent variable into the explanatory variables
@@ -816,6 +2239,18 @@ def shrinkage_cov(r, delta=0.5, **kwargs):
     return delta*prior + (1-delta)*sample
 
 
+def shrinkage_cov_stacked(windows, delta=0.5, **kwargs):
+    """
+    Stacked version of shrinkage_cov: returns the n_starts x N x N shrunk covariances of the windows in starts
+    """
+    kwargs["sample"] = sample_cov_stacked(windows, **kwargs)
+    prior = cc_cov_stacked(windows, **kwargs)
+    return delta*prior + (1-delta)*kwargs["sample"]
+
+shrinkage_cov.stacked = shrinkage_cov_stacked
+shrinkage_cov.uses_sample_cov = True
+
+
 def skewness(r: pd.Series or pd.DataFrame):
     """
     Alternative to scipy.stats.skew()
@@ -829,13 +2264,15 @@ def skewness(r: pd.Series or pd.DataFrame):
     return exp / (sigma_r**3)
 
 
-def style_analysis(dependent_variable, explanatory_variables):
+def style_analysis(dependent_variable, explanatory_variables, ctx=None):
     """
     Returns the optimal weights that minimizes the Tracking error between
     a portfolio of the explanatory variables and the dependent variable
+    ctx is an optional OptimizerContext to warm start from the previous call, e.g. in a rolling style analysis
     """
     n = explanatory_variables.shape[1]
-    init_guess = np.repeat(1/n, n)
+    state = ctx.get("style_analysis", n) if ctx is not None else None
+    init_guess = np.repeat(1/n, n) if state is None else state["x"]
     bounds = ((0.0, 1.0),) * n # an N-tuple of 2-tuples!
     # construct the constraints
     weights_sum_to_1 = {'type': 'eq',
@@ -846,6 +2283,8 @@ def style_analysis(dependent_variable, explanatory_variables):
                        options={'disp': False},
                        constraints=(weights_sum_to_1,),
                        bounds=bounds)
+    if ctx is not None:
+        ctx.save("style_analysis", n, solution.nit, x=solution.x)
     weights = pd.Series(solution.x, index=explanatory_variables.columns)
     return weights
 
@@ -853,7 +2292,12 @@ def style_analysis(dependent_variable, explanatory_variables):
 def summary_stats(r, riskfree_rate=0.03):
     """
     Return a DataFrame that contains aggregated summary stats for the returns in the columns of r
+    Complete numeric DataFrames go through the fused array kernel summary_stats_arrays, anything else
+    (missing values, Series) through the column by column aggregates
     """
+    values = r.to_numpy(dtype=np.float64, na_value=np.nan) if isinstance(r, pd.DataFrame) else None
+    if values is not None and len(values) > 0 and not np.isnan(values).any():
+        return pd.DataFrame(summary_stats_arrays(values, riskfree_rate=riskfree_rate), index=r.columns)
     ann_r = r.aggregate(annualize_rets, periods_per_year=12)
     ann_vol = r.aggregate(annualize_vol, periods_per_year=12)
     ann_sr = r.aggregate(sharpe_ratio, riskfree_rate=riskfree_rate, periods_per_year=12)
@@ -874,6 +2318,61 @@ def summary_stats(r, riskfree_rate=0.03):
     })
 
 
+def summary_stats_arrays(r, riskfree_rate=0.03, periods_per_year=12, level=5):
+    """
+    Array version of summary_stats: r is a T x N array of monthly returns without missing values
+    The central moments are computed once from the demeaned returns and shared by the volatility, skewness,
+    kurtosis and Cornish-Fisher VaR, the wealth index is shared by the annualized return and the max drawdown,
+    and a single partition per column gives the historic VaR threshold of the CVaR
+    Returns a dict of the summary_stats columns, each an array of N stats
+    """
+    r = np.asarray(r, dtype=np.float64)
+    if r.ndim == 1:
+        r = r[:, None]
+    n_periods = r.shape[0]
+    # moments
+    mean = r.mean(axis=0)
+    demeaned = r - mean
+    demeaned_sq = demeaned**2
+    m_2 = demeaned_sq.mean(axis=0)
+    m_3 = (demeaned_sq*demeaned).mean(axis=0)
+    m_4 = (demeaned_sq**2).mean(axis=0)
+    pop_std = np.sqrt(m_2)
+    ann_vol = np.sqrt(m_2*n_periods/(n_periods-1))*periods_per_year**0.5
+    skew = m_3/pop_std**3
+    kurt = m_4/pop_std**4
+    z = norm.ppf(level/100)
+    z_cf = z + (z**2 - 1)*skew/6 + (z**3 - 3*z)*(kurt-3)/24 - (2*z**3 - 5*z)*(skew**2)/36
+    cf_var = -(mean + z_cf*pop_std)
+    # wealth index: annualized returns and drawdowns
+    wealth = 1000*np.cumprod(1+r, axis=0)
+    ann_r = (wealth[-1]/1000)**(periods_per_year/n_periods)-1
+    peaks = np.maximum.accumulate(wealth, axis=0)
+    max_dd = ((wealth - peaks)/peaks).min(axis=0)
+    rf_period = (1 + riskfree_rate)**(1/periods_per_year) - 1
+    ann_ex_r = np.prod(1 + (r - rf_period), axis=0)**(periods_per_year/n_periods)-1
+    # historic CVaR: mean of the returns at or below the level-th percentile (linear interpolation)
+    k = (n_periods-1)*level/100
+    lo = int(np.floor(k))
+    hi = min(lo+1, n_periods-1)
+    part = np.partition(r, (lo, hi), axis=0)
+    threshold = part[lo] + (part[hi] - part[lo])*(k - lo)
+    is_beyond = r <= threshold
+    hist_cvar = -np.where(is_beyond, r, 0).sum(axis=0)/is_beyond.sum(axis=0)
+    return {
+        "Annualized Return": ann_r,
+        "Annualized Vol": ann_vol,
+        "Skewness": skew,
+        "Kurtosis": kurt,
+        "Cornish-Fisher VaR (5%)": cf_var,
+        "Historic CVaR (5%)": hist_cvar,
+        "Sharpe Ratio": ann_ex_r/ann_vol,
+        "Max Drawdown": max_dd
+    }
+
+summary_stats.arrays = summary_stats_arrays
+
+
 def terminal_values(rets):
     """
     Computes the terminal values from a set of returns supplied as a T x N DataFrame
@@ -888,25 +2387,219 @@ def terminal_stats(rets, floor = 0.8, cap=np.inf, name="Stats"):
     across a range of N scenarios
     rets is a T x N DataFrame of returns, where T is the time-step (we assume rets is sorted by time)
     Returns a 1 column DataFrame of Summary Stats indexed by the stat name
-    """
-    terminal_wealth = (rets+1).prod()
-    breach = terminal_wealth < floor
-    reach = terminal_wealth >= cap
-    p_breach = breach.mean() if breach.sum() > 0 else np.nan
-    p_reach = breach.mean() if reach.sum() > 0 else np.nan
-    e_short = (floor-terminal_wealth[breach]).mean() if breach.sum() > 0 else np.nan
-    e_surplus = (cap-terminal_wealth[reach]).mean() if reach.sum() > 0 else np.nan
-    sum_stats = pd.DataFrame.from_dict({
-        "mean": terminal_wealth.mean(),
-        "std" : terminal_wealth.std(),
-        "p_breach": p_breach,
-        "e_short":e_short,
-        "p_reach": p_reach,
-        "e_surplus": e_surplus
-    }, orient="index", columns=[name])
+    If rets has MultiIndex columns (as returned by bt_mix_sweep), the scenarios are the last level and
+    one column of stats is returned per combination of the other levels
+    """
+    sum_stats = terminal_stats_table(rets, floors=[floor], caps=[cap], name=name)
+    return sum_stats.droplevel("threshold").rename_axis(index=None)
+
+
+def terminal_stats_table(rets, floors=0.8, caps=np.inf, name="Stats"):
+    """
+    Produce Summary Statistics on the terminal values per invested dollar of several strategies
+    for whole vectors of floors and caps in a single pass
+    rets is a T x N DataFrame of returns, a dict of strategy name -> T x N DataFrame, or a DataFrame with
+    MultiIndex columns as returned by bt_mix_sweep (the scenarios are the last level)
+    Each strategy is compounded once (log1p-sum) and sorted, the breach/reach probabilities and the
+    expected shortfall/surplus at every threshold are then read off the prefix sums with searchsorted
+    The probabilities and expectations are NaN when no scenario breaches the floor (reaches the cap)
+    Returns a DataFrame with one column per strategy, indexed by (stat, threshold)
+    """
+    columns_name = None
+    if isinstance(rets, dict):
+        terminal_wealth = {key: compound_terminal(r) for key, r in rets.items()}
+    elif isinstance(rets.columns, pd.MultiIndex):
+        levels = list(range(rets.columns.nlevels - 1))
+        groups = pd.Series(compound_terminal(rets), index=rets.columns).groupby(
+            level=levels if len(levels) > 1 else 0, sort=False)
+        terminal_wealth = {key: tw.values for key, tw in groups}
+        columns_name = rets.columns.names[:-1]
+    else:
+        terminal_wealth = {name: compound_terminal(rets)}
+
+    sum_stats = []
+    for key, tw in terminal_wealth.items():
+        acc = TerminalStatsAccumulator(floors, caps)
+        acc.add_terminal_wealth(tw)
+        sum_stats.append(acc.result(name=key))
+    sum_stats = pd.concat(sum_stats, axis=1)
+    if columns_name is not None:
+        sum_stats = sum_stats.rename_axis(columns=columns_name)
     return sum_stats
 
 
+def compound_terminal(rets):
+    """
+    Terminal values per invested dollar of a T x N array or DataFrame of returns, computed as a log1p-sum
+    (missing returns are skipped). Returns an array of length N
+    """
+    return np.exp(np.nansum(np.log1p(np.asarray(rets, dtype=np.float64)), axis=0))
+
+
+class TerminalStatsAccumulator:
+    """
+    Accumulates the terminal_stats_table statistics of one strategy over blocks of scenarios.
+    Only keeps O(number of thresholds) numbers: the count, mean and sum of squared deviations of the terminal
+    values (merged across blocks with the pairwise update of Chan et al.) and the count and sum of the
+    terminal values below each floor and at or above each cap
+    """
+
+    def __init__(self, floors=0.8, caps=np.inf):
+        self.floors = np.atleast_1d(np.asarray(floors, dtype=np.float64))
+        self.caps = np.atleast_1d(np.asarray(caps, dtype=np.float64))
+        self.n = 0
+        self.mean = 0.
+        self.m2 = 0.
+        self.n_breach = np.zeros(len(self.floors), dtype=np.int64)
+        self.sum_breach = np.zeros(len(self.floors))
+        self.n_reach = np.zeros(len(self.caps), dtype=np.int64)
+        self.sum_reach = np.zeros(len(self.caps))
+
+    def update(self, rets):
+        """ Adds a T x n block of returns """
+        self.add_terminal_wealth(compound_terminal(rets))
+
+    def add_terminal_wealth(self, terminal_wealth):
+        """ Adds the terminal values of a block of scenarios """
+        tw = np.sort(np.asarray(terminal_wealth, dtype=np.float64).ravel())
+        n = len(tw)
+        if n == 0:
+            return
+        cum_tw = np.concatenate([[0.], np.cumsum(tw)])
+        n_breach = np.searchsorted(tw, self.floors, side="left")  # terminal_wealth < floor
+        n_reach = n - np.searchsorted(tw, self.caps, side="left")  # terminal_wealth >= cap
+        mean = tw.mean()
+        self._merge(n, mean, ((tw - mean)**2).sum(), n_breach, cum_tw[n_breach],
+                    n_reach, cum_tw[n] - cum_tw[n - n_reach])
+
+    def merge(self, other):
+        """ Adds the scenarios accumulated by another accumulator with the same floors and caps """
+        self._merge(other.n, other.mean, other.m2, other.n_breach, other.sum_breach, other.n_reach, other.sum_reach)
+
+    def _merge(self, n, mean, m2, n_breach, sum_breach, n_reach, sum_reach):
+        if n == 0:
+            return
+        total = self.n + n
+        delta = mean - self.mean
+        self.mean = self.mean + delta*n/total
+        self.m2 = self.m2 + m2 + delta**2*self.n*n/total
+        self.n = total
+        self.n_breach += n_breach
+        self.sum_breach += sum_breach
+        self.n_reach += n_reach
+        self.sum_reach += sum_reach
+
+    def result(self, name="Stats"):
+        """ Returns a 1 column DataFrame of Summary Stats indexed by (stat, threshold), as terminal_stats_table """
+        with np.errstate(divide="ignore", invalid="ignore"):
+            values = np.concatenate([
+                [self.mean if self.n else np.nan, np.sqrt(self.m2/(self.n-1)) if self.n > 1 else np.nan],
+                np.where(self.n_breach > 0, self.n_breach/self.n, np.nan),
+                np.where(self.n_breach > 0, self.floors - self.sum_breach/self.n_breach, np.nan),
+                np.where(self.n_reach > 0, self.n_reach/self.n, np.nan),
+                np.where(self.n_reach > 0, self.sum_reach/self.n_reach - self.caps, np.nan)
+            ])
+        index = pd.MultiIndex.from_tuples(
+            [("mean", np.nan), ("std", np.nan)]
+            + [("p_breach", f) for f in self.floors] + [("e_short", f) for f in self.floors]
+            + [("p_reach", c) for c in self.caps] + [("e_surplus", c) for c in self.caps], names=["stat", "threshold"])
+        return pd.DataFrame({name: values}, index=index)
+
+
+def terminal_stats_blocks(generate, strategies, n_scenarios, floors=0.8, caps=np.inf, block_size=None,
+                          max_memory=2**28):
+    """
+    Memory bounded version of the generate -> bt_mix -> terminal_stats_table pipeline.
+    The scenarios are generated, allocated and summarised in blocks of columns and the statistics are
+    accumulated across blocks (see TerminalStatsAccumulator), so the full T x N matrices never exist
+    generate(n) returns a dict of T x n DataFrames or arrays for a new block of n scenarios, e.g.
+    {"eq": returns of the PSP, "zc": returns of the GHP, "zc_prices": prices of the zero coupon bond}
+    strategies is a dict of strategy name -> function(block) returning the T x n returns of the strategy, e.g.
+    lambda block: bt_mix(block["eq"], block["zc"], floor_allocator, floor=.75, zc_prices=block["zc_prices"])
+    block_size is the number of scenarios per block, if None it is derived after the first block from the measured
+    size of the block, so that generating a block and running a strategy on it stays within about max_memory bytes
+    Returns the terminal_stats_table of all the strategies over the n_scenarios
+    """
+    accumulators = {name: TerminalStatsAccumulator(floors, caps) for name in strategies}
+    size = block_size or min(n_scenarios, 256)
+    done = 0
+    while done < n_scenarios:
+        size = min(size, n_scenarios - done)
+        block = generate(size)
+        block_bytes = sum(np.asarray(values).nbytes for values in block.values())
+        strategy_bytes = 0
+        for name, strategy in strategies.items():
+            rets = strategy(block)
+            accumulators[name].update(rets)
+            strategy_bytes = max(strategy_bytes, np.asarray(rets).nbytes)
+            del rets
+        done += size
+        if block_size is None:
+            # generating a block takes about as much again in temporaries, and a strategy holds about
+            # 4 T x n arrays at once (returns, weights and the bt_mix temporaries)
+            size = max(1, int(max_memory*size // (2*block_bytes + 4*strategy_bytes)))
+    return pd.concat([acc.result(name=name) for name, acc in accumulators.items()], axis=1)
+
+
+def mc_mean(samples, antithetic=False, control=None, control_mean=None):
+    """
+    Monte Carlo estimate of the mean of the N samples of a quantity, and its standard error
+    antithetic: samples 2i and 2i+1 come from antithetic shocks (see normal_shocks), so the standard error
+    is computed on the averages of the pairs
+    control, control_mean: N samples of a control variate with a known mean, e.g. the terminal value per dollar of
+    the gbm scenarios whose expectation is (1+mu)**n_years, the estimate is then the mean of
+    samples - beta*(control - control_mean) with the beta that minimises its variance
+    Returns a tuple (estimate, standard error)
+    """
+    x = np.asarray(samples, dtype=np.float64)
+    c = None if control is None else np.asarray(control, dtype=np.float64)
+    if antithetic:
+        x = (x[0::2] + x[1::2])/2
+        c = None if c is None else (c[0::2] + c[1::2])/2
+    if c is not None:
+        c_dev = c - c.mean()
+        c_var = c_dev @ c_dev
+        beta = ((x - x.mean()) @ c_dev)/c_var if c_var > 0 else 0.
+        x = x - beta*(c - control_mean)
+    return x.mean(), x.std(ddof=1)/np.sqrt(len(x))
+
+
+def terminal_stats_mc(rets, floor=0.8, cap=np.inf, antithetic=False, control=None, control_mean=None, name="Stats"):
+    """
+    Same statistics as terminal_stats (except the std) with the standard error of each Monte Carlo estimate
+    antithetic, control and control_mean are passed to mc_mean (control are the N terminal values of the control,
+    e.g. compound_terminal of the gbm returns), e_short and e_surplus are ratio estimates whose standard error
+    is obtained by the delta method
+    Returns a DataFrame indexed by the stat name with (name, "estimate") and (name, "std_error") columns
+    """
+    tw = compound_terminal(rets)
+    breach = (tw < floor).astype(np.float64)
+    reach = (tw >= cap).astype(np.float64)
+
+    def estimate(x):
+        return mc_mean(x, antithetic=antithetic, control=control, control_mean=control_mean)
+
+    def ratio(x, y):
+        # E[x]/E[y] with the standard error of the linearised estimator (x - ratio*y)/E[y]
+        e_y = estimate(y)[0]
+        if e_y <= 0:
+            return np.nan, np.nan
+        r = estimate(x)[0]/e_y
+        return r, estimate(x - r*y)[1]/e_y
+
+    p_breach = estimate(breach)
+    p_reach = estimate(reach)
+    sum_stats = {
+        "mean": estimate(tw),
+        "p_breach": p_breach if breach.sum() > 0 else (np.nan, np.nan),
+        "e_short": ratio(np.where(breach > 0, floor - tw, 0.), breach),
+        "p_reach": p_reach if reach.sum() > 0 else (np.nan, np.nan),
+        "e_surplus": ratio(np.where(reach > 0, tw - cap, 0.), reach)
+    }
+    return pd.DataFrame.from_dict(sum_stats, orient="index",
+                                  columns=pd.MultiIndex.from_product([[name], ["estimate", "std_error"]]))
+
+
 def tracking_error(r_a, r_b):
     """
     Returns the Tracking Error between the two return series
@@ -980,14 +2673,23 @@ def w_msr(sigma, mu, scale=True):
     return w
 
 
-def target_risk_contributions(target_risk, cov):
+def target_risk_contributions(target_risk, cov, init_guess=None, ctx=None):
     """
     Returns the weights of the portfolio that gives you the weights such
     that the contributions to portfolio risk are as close as possible to
     the target_risk, given the covariance matrix
+    Non negative targets are solved exactly by risk_budgeting, starting from init_guess if supplied
+    or from the previous solution in the OptimizerContext ctx
     """
+    target = np.asarray(target_risk, dtype=float)
+    if (target >= 0).all() and target.sum() > 0:
+        return risk_budgeting(cov, budgets=target, init_guess=init_guess, ctx=ctx)
+
     n = cov.shape[0]
-    init_guess = np.repeat(1 / n, n)
+    state = ctx.get("target_risk_contributions", n) if ctx is not None and init_guess is None else None
+    if init_guess is None:
+        init_guess = np.repeat(1 / n, n) if state is None else state["x"]
+    init_guess = np.asarray(init_guess, dtype=float)
     bounds = ((0.0, 1.0),) * n  # an N-tuple of 2-tuples!
     # construct the constraints
     weights_sum_to_1 = {'type': 'eq',
@@ -1007,21 +2709,34 @@ def target_risk_contributions(target_risk, cov):
                        options={'disp': False},
                        constraints=(weights_sum_to_1,),
                        bounds=bounds)
+    if ctx is not None:
+        ctx.save("target_risk_contributions", n, weights.nit, x=weights.x)
     return weights.x
 
 
-def equal_risk_contributions(cov):
+def equal_risk_contributions(cov, ctx=None):
     """
     Returns the weights of the portfolio that equalizes the contributions
     of the constituents based on the given covariance matrix
     """
     n = cov.shape[0]
-    return target_risk_contributions(target_risk=np.repeat(1 / n, n), cov=cov)
+    return target_risk_contributions(target_risk=np.repeat(1 / n, n), cov=cov, ctx=ctx)
 
 
-def weight_erc(r, cov_estimator=sample_cov, **kwargs):
+def weight_erc(r, cov_estimator=sample_cov, ctx=None, **kwargs):
     """
     Produces the weights of the ERC portfolio given a covariance matrix of the returns
     """
     est_cov = cov_estimator(r, **kwargs)
-    return equal_risk_contributions(est_cov)
\ No newline at end of file
+    return equal_risk_contributions(est_cov, ctx=ctx)
+
+
+def weight_erc_stacked(windows, r, cov_estimator=sample_cov, ctx=None, **kwargs):
+    """
+    Stacked version of weight_erc: returns an n_starts x N array with the ERC weights of the windows in starts
+    """
+    est_covs = cov_estimator.stacked(windows, **kwargs)
+    return np.array([equal_risk_contributions(est_cov, ctx=ctx) for est_cov in est_covs])
+
+weight_erc.stacked = weight_erc_stacked
+weight_erc.uses_sample_cov = True
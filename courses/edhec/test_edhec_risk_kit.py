@@ -0,0 +1,98 @@
+import numpy as np
+import pandas as pd
+from courses.edhec import edhec_risk_kit as erk
+
+
+def test_gmv_rank_deficient_covariance():
+    """ Estimation windows shorter than the number of assets give singular covariance matrices """
+    rng = np.random.default_rng(0)
+    r = pd.DataFrame(rng.normal(0.01, 0.05, (40, 20)), index=pd.period_range("2000-01", periods=40, freq="M"))
+    r[1] = r[0]
+    cov = r.iloc[:8].cov().values
+    w = erk.gmv(cov)
+    assert w.min() >= 0 and np.isclose(w.sum(), 1)
+    bt = erk.backtest_ws(r, estimation_window=8, weighting=erk.weight_gmv)
+    assert bt.notna().sum() == len(r) - 8
+
+
+def test_min_var_warm_start_singular_free_set():
+    """ A warm start must not fail where a cold start succeeds """
+    ctx = erk.OptimizerContext()
+    erk.min_var_long_only(np.eye(3), np.ones(3), ctx=ctx)
+    cov = np.array([[1., 1., 0.], [1., 1., 0.], [0., 0., 1.]])
+    w = erk.min_var_long_only(cov, np.ones(3), ctx=ctx)
+    assert np.isclose(w @ cov @ w, 0.5)
+
+
+def test_backtest_custom_weighting_without_rolling_cov():
+    """ Weightings that do not opt in to uses_sample_cov are called with the window only """
+    rng = np.random.default_rng(0)
+    r = pd.DataFrame(rng.normal(0.01, 0.05, (60, 5)), index=pd.period_range("2000-01", periods=60, freq="M"))
+
+    def inv_vol(r):
+        w = 1/r.std()
+        return w/w.sum()
+
+    bt = erk.backtest_ws(r, estimation_window=24, weighting=inv_vol)
+    assert bt.notna().sum() == len(r) - 24
+
+
+def test_cached_estimator_goes_through_cache_in_backtests():
+    """ A cached estimator must not expose the uncached stacked version of the estimator """
+    rng = np.random.default_rng(0)
+    r = pd.DataFrame(rng.normal(0.01, 0.05, (60, 5)), index=pd.period_range("2000-01", periods=60, freq="M"))
+    cache = erk.EstimatorCache()
+    cov_estimator = erk.cached(erk.cc_cov, cache)
+    strategies = {"GMV": dict(weighting=erk.weight_gmv, cov_estimator=cov_estimator),
+                  "ERC": dict(weighting=erk.weight_erc, cov_estimator=cov_estimator)}
+    erk.backtest_strategies(r, strategies, estimation_window=24)
+    assert cache.stats()["misses"] == len(r) - 24
+    assert cache.stats()["hits"] == len(r) - 24
+
+
+def test_quasi_normal_shocks_brownian_bridge():
+    """ Row 0 is not drawn, and the first Sobol coordinate sets the sum of the shocks (the terminal value) """
+    shock = erk.quasi_normal_shocks(np.random.default_rng(0), (13, 256, 2))
+    assert not shock[0].any()
+    z = np.random.default_rng(1).standard_normal((12, 5))
+    increments = erk.brownian_bridge_increments(z)
+    assert np.allclose(increments.sum(axis=0), np.sqrt(12)*z[0])
+
+
+def test_scenario_store_keeps_labels_and_drops_stale_parts(tmp_path):
+    """ Saved DataFrames come back with their labels, and re-saving a set removes the parts it no longer has """
+    store = erk.ScenarioStore(str(tmp_path))
+    rets = pd.DataFrame(np.random.default_rng(0).random((4, 3)), columns=["Steel", "Fin", "Beer"],
+                        index=pd.period_range("2000-01", periods=4, freq="M"))
+    prices = erk.gbm(n_scenarios=3, rng=1, method="exact", times=[0, 0.5, 1.25])
+    loaded = store.save("set", (rets, prices, np.arange(3.)))
+    pd.testing.assert_frame_equal(loaded[0], rets)
+    pd.testing.assert_frame_equal(loaded[1], prices)
+    store.save("set", {"rets": rets})
+    assert sorted(p.name for p in (tmp_path / "set").iterdir()) == ["0.npy", "metadata.json"]
+
+
+def test_backtest_ew_does_not_estimate_covariances(monkeypatch):
+    """ The shared sample covariances are only computed for the strategies that read them """
+    rng = np.random.default_rng(0)
+    r = pd.DataFrame(rng.normal(0.01, 0.05, (60, 5)), index=pd.period_range("2000-01", periods=60, freq="M"))
+
+    def no_covariances(*args, **kwargs):
+        raise AssertionError("EW does not need covariances")
+
+    monkeypatch.setattr(erk, "sample_cov_stacked", no_covariances)
+    bt = erk.backtest_ws(r, estimation_window=24, weighting=erk.weight_ew)
+    assert bt.notna().sum() == len(r) - 24
+
+
+def test_parallel_backtest_matches_serial_with_cap_weights():
+    """ Parallel chunks can be smaller than a block of ROLLING_BLOCK windows and still match the serial path """
+    rng = np.random.default_rng(0)
+    r = pd.DataFrame(rng.normal(0.01, 0.05, (120, 6)), index=pd.period_range("1974-01", periods=120, freq="M"))
+    cap_weights = pd.DataFrame(rng.random((120, 6)), index=r.index, columns=r.columns)
+    strategies = {"CW": dict(weighting=erk.weight_cw, cap_weights=cap_weights),
+                  "EW": dict(weighting=erk.weight_ew, cap_weights=cap_weights, microcap_threshold=0.1),
+                  "GMV": dict(weighting=erk.weight_gmv)}
+    serial = erk.backtest_strategies(r, strategies, estimation_window=36)
+    parallel = erk.backtest_strategies(r, strategies, estimation_window=36, n_jobs=2)
+    pd.testing.assert_frame_equal(parallel, serial, check_exact=True)